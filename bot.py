@@ -1,13 +1,16 @@
 # bot_pay_products_admin_fixed.py
 import os
 import asyncio
+import html
 import logging
+import time
 from datetime import datetime, UTC
 from typing import Optional
-import aiosqlite
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, Router, F
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.types import (
@@ -18,8 +21,29 @@ from aiogram.types import (
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     CallbackQuery,
+    BufferedInputFile,
 )
 from aiogram.filters import CommandStart, Command, CommandObject
+from aiogram.exceptions import (
+    TelegramAPIError,
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramRetryAfter,
+)
+from storage import (
+    create_storage,
+    now_ts,
+    ts_to_str,
+    parse_segment,
+    RCPT_PENDING,
+    RCPT_SENT,
+    RCPT_BLOCKED,
+    RCPT_FAILED,
+)
+from entitlements import Entitlements, PremiumMiddleware
+from leaderboard import Leaderboard
+from logs import setup_logging, UpdateContextMiddleware, HandlerNameMiddleware
+from profiler import ProfileSession
 
 # ------------------ Бағдарламалық баптаулар (ORTA / ENV арқылы беріледі) ------------------
 # Ешқашан тікелей кодқа токен жазбаңыз — орта айнымалы арқылы орнатыңыз.
@@ -32,18 +56,53 @@ PROVIDER_TOKEN = os.getenv("PROVIDER_TOKEN")  # Telegram payment provider token
 ADMIN_ID = int(os.getenv("ADMIN_ID"))  # әкімшінің Telegram ID (оқшауланған ортада орнатыңыз)
 CURRENCY = os.getenv("CURRENCY", "XTR")  # Валюта (Stars = XTR)
 DB_PATH = os.getenv("DB_PATH")
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE")  # жергілікті/жалған Bot API сервері (мыс. fake_telegram.py)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")  # sqlite | memory (тесттер/бенчмарктар үшін)
+LEADERBOARD_SIZE = int(os.getenv("LEADERBOARD_SIZE", "10"))  # /top ішіндегі донорлар саны
+ENTITLEMENT_CACHE_SIZE = int(os.getenv("ENTITLEMENT_CACHE_SIZE", "10000"))  # Premium кэшіндегі пайдаланушылар саны
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FILE = os.getenv("LOG_FILE")  # бос болса — stderr
+LOG_DEDUP_SECONDS = float(os.getenv("LOG_DEDUP_SECONDS", "60"))  # қайталанатын қателерді басу терезесі
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))  # жүктеме кезінде INFO жолдарының қалатын үлесі
+LOG_SAMPLE_QUEUE = int(os.getenv("LOG_SAMPLE_QUEUE", "1000"))  # кезек осыдан ұзын болса — жүктеме
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))  # хабарлама/сек (Telegram шегі ~30/сек)
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))  # бір уақыттағы сұраныстар саны
 
 # ------------------ Aiogram init ------------------
 load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
+session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_BASE)) if TELEGRAM_API_BASE else None
+bot = Bot(token=BOT_TOKEN, session=session, default=DefaultBotProperties(parse_mode="HTML"))
 dp = Dispatcher()
 router = Router()
 dp.include_router(router)
 
-logging.basicConfig(level=logging.INFO)
+log_listener = setup_logging(
+    level=LOG_LEVEL,
+    dedup_window=LOG_DEDUP_SECONDS,
+    sample_rate=LOG_SAMPLE_RATE,
+    sample_threshold=LOG_SAMPLE_QUEUE,
+    log_file=LOG_FILE,
+)
 logger = logging.getLogger(__name__)
+# aiogram-ның әр update-ке жазатын мәтіндік "is handled" жолы төмендегі құрылымды "update handled"-пен қайталанады
+logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+
+# update_id / user_id / handler / duration_ms өрістері әр лог жазбасына
+dp.update.outer_middleware(UpdateContextMiddleware(logger))
+router.message.middleware(HandlerNameMiddleware())
+router.callback_query.middleware(HandlerNameMiddleware())
+router.pre_checkout_query.middleware(HandlerNameMiddleware())
+
+storage = create_storage(STORAGE_BACKEND, DB_PATH)
+entitlements = Entitlements(storage, ENTITLEMENT_CACHE_SIZE)
+leaderboard = Leaderboard(storage, LEADERBOARD_SIZE)
+
+# flags={"premium": True} бар хэндлерлер тек белсенді жазылымы барларға қолжетімді
+premium_middleware = PremiumMiddleware(entitlements, "🔒 Бұл мүмкіндік тек белсенді жазылымы барларға. /pay арқылы жазылыңыз.")
+router.message.middleware(premium_middleware)
+router.callback_query.middleware(premium_middleware)
 
 # ------------------ FSM күйі (донейт хабарламасын сұрағанда) ------------------
 class Donate(StatesGroup):
@@ -51,87 +110,19 @@ class Donate(StatesGroup):
     waiting_for_amount = State()
     waiting_for_custom_amount = State()
 
-# ------------------ DB инициализация ------------------
-async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        # products: ұсыныстар/жазылымдар/пакеттер
-        await db.execute(
-            """
-            CREATE TABLE IF NOT EXISTS products (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                title TEXT NOT NULL,
-                description TEXT,
-                amount INTEGER NOT NULL,
-                currency TEXT NOT NULL,
-                duration_days INTEGER DEFAULT 0,
-                active INTEGER DEFAULT 1
-            )
-            """
-        )
-        # payments: нақты төлем жазбасы (қолдау хабарламасы үшін message бағаны қосылды)
-        await db.execute(
-            """
-            CREATE TABLE IF NOT EXISTS payments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                product_id INTEGER,
-                amount INTEGER NOT NULL,
-                currency TEXT,
-                charge_id TEXT UNIQUE,
-                date TEXT,
-                refunded INTEGER DEFAULT 0,
-                message TEXT
-            )
-            """
-        )
-        # subscriptions: пайдаланушы жазылымдары
-        await db.execute(
-            """
-            CREATE TABLE IF NOT EXISTS subscriptions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                product_id INTEGER,
-                start_date TEXT,
-                expiry_date TEXT
-            )
-            """
-        )
-        # refunds: локал журнал
-        await db.execute(
-            """
-            CREATE TABLE IF NOT EXISTS refunds (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                charge_id TEXT,
-                admin_id INTEGER,
-                reason TEXT,
-                date TEXT
-            )
-            """
-        )
-        # pending_donations: төлемге дейінгі донейт хабарламаларын сақтау (payload-қа сілтеме жасаймыз)
-        await db.execute(
-            """
-            CREATE TABLE IF NOT EXISTS pending_donations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                amount INTEGER NOT NULL,
-                message TEXT,
-                created_at TEXT
-            )
-            """
-        )
-        await db.commit()
-    logger.info("DB initialized.")
-
-# ------------------ Helper: fetch products ------------------
-async def get_active_products(limit: int = 50):
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute(
-            "SELECT id, title, description, amount, currency, duration_days FROM products WHERE active=1 ORDER BY id ASC LIMIT ?",
-            (limit,),
-        ) as cur:
-            rows = await cur.fetchall()
-    return rows
+# 'YYYY-MM-DD [YYYY-MM-DD]' → (from_ts, to_ts); to_ts — соңғы күннің соңы (ол күн де кіреді)
+def parse_date_range(args: Optional[str]) -> tuple[Optional[int], Optional[int]]:
+    if not args:
+        return None, None
+    parts = args.split()
+    if len(parts) > 2:
+        raise ValueError("ең көбі екі күн берілуі керек")
+    days = [datetime.strptime(p, "%Y-%m-%d").replace(tzinfo=UTC) for p in parts]
+    start = int(days[0].timestamp())
+    end = int(days[-1].timestamp()) + 86400
+    if end <= start:
+        raise ValueError("соңғы күн бастапқы күннен кейін болуы керек")
+    return start, end
 
 # ------------------ Командалар: START / HELP ------------------
 @router.message(CommandStart())
@@ -152,21 +143,26 @@ async def cmd_help(message: Message):
         "/pay — өнімдер тізімі және сатып алу\n"
         "/premium — Premium / жазылым күйін көру\n"
         "/donate — ботты жұлдыз (Stars) арқылы қолдау\n"
+        "/top [day|week|month] — үздік қолдаушылар\n"
         "/help — көмек пен пәрмендер тізімі\n\n"
         "<b>👑 Әкімші пәрмендері:</b>\n"
-        "/stats — жалпы статистика\n"
+        "/stats [YYYY-MM-DD] [YYYY-MM-DD] — жалпы статистика (кезең бойынша)\n"
+        "/refunds [YYYY-MM-DD] [YYYY-MM-DD] — қайтарулар журналы (кезең бойынша)\n"
         "/refund [ID] — төлемді қайтару\n"
         "/add_product [атауы]|[бағасы]|[күндер]|[сипаттамасы] — жаңа өнім қосу\n"
         "/edit_product [id]|[атауы]|[бағасы]|[күндер]|[сипаттамасы] — өнімді өзгерту\n"
         "/set_product_status [id] [0|1] — өнімді қосу/өшіру\n"
         "/delete_product [id] — өнімді жою\n"
-        "/mark_refund [charge_id] — төлемді қайтарылған деп белгілеу"
+        "/mark_refund [charge_id] — төлемді қайтарылған деп белгілеу\n"
+        "/broadcast [subscribers|payers|product:ID] [мәтін] — хабарлама тарату\n"
+        "/broadcast_status [id] — тарату барысы\n"
+        "/profile [секунд] — ботты профильдеу (есеп + collapsed stacks)"
     )
 
 # ------------------ PAY: өнімдер тізімі және сатып алу ------------------
 @router.message(Command("pay"))
 async def cmd_pay(message: Message):
-    products = await get_active_products()
+    products = await storage.get_active_products()
     if not products:
         return await message.answer("Қазір ұсыныстар жоқ. Кейінірек қайта көріңіз.")
 
@@ -194,16 +190,12 @@ async def buy_callback(callback: CallbackQuery):
         return await callback.message.answer("Өнім идентификаторы қате.")
 
     # өнімді DB-дан жүктеу
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute(
-            "SELECT title, description, amount, currency FROM products WHERE id = ? AND active = 1", (pid,)
-        ) as cur:
-            row = await cur.fetchone()
+    row = await storage.get_product(pid, active_only=True)
 
     if not row:
         return await callback.message.answer("Өнім табылмады немесе белсенді емес.")
 
-    title, description, amount, currency = row
+    _, title, description, amount, currency, _, _ = row
     prices = [LabeledPrice(label=title, amount=amount)]
     payload = f"product:{pid}"  # кейінгі өңдеуде қолданамыз
 
@@ -311,15 +303,7 @@ async def _send_invoice(message_or_callback, amount: int, state: FSMContext):
     user_message = state_data.get("user_message", None)
     await state.clear()
 
-    created_at = datetime.now(UTC).strftime("%Y-%m-%d %H:%M:%S")
-
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "INSERT INTO pending_donations (user_id, amount, message, created_at) VALUES (?, ?, ?, ?)",
-            (user_id, amount, user_message, created_at)
-        )
-        await db.commit()
-        pending_id = cur.lastrowid
+    pending_id = await storage.add_pending_donation(user_id, amount, user_message, now_ts())
 
     prices = [LabeledPrice(label="Ботты қолдау ⭐", amount=amount)]
     payload = f"donation:{pending_id}"
@@ -337,62 +321,10 @@ async def _send_invoice(message_or_callback, amount: int, state: FSMContext):
             start_parameter="donate_support"
         )
     except Exception as e:
-        logging.exception("Invoice жіберу сәтсіз")
+        logger.exception("Invoice жіберу сәтсіз")
         await message_or_callback.answer(f"❌ Төлем бастау мүмкін болмады: {e}")
 
 
-# ------------------ Төлем сәтті болған соң ------------------
-@router.message(F.successful_payment)
-async def successful_payment(message: Message):
-    sp = message.successful_payment
-    user = message.from_user
-
-    payload = getattr(sp, "invoice_payload", None)
-    pending_id = None
-    if payload and payload.startswith("donation:"):
-        try:
-            pending_id = int(payload.split(":")[1])
-        except Exception:
-            pending_id = None
-
-    amount = sp.total_amount
-    currency = sp.currency
-    charge_id = sp.telegram_payment_charge_id
-
-    async with aiosqlite.connect(DB_PATH) as db:
-        user_message = None
-        if pending_id:
-            async with db.execute("SELECT message FROM pending_donations WHERE id=?", (pending_id,)) as cur:
-                row = await cur.fetchone()
-                if row:
-                    user_message = row[0]
-        await db.execute(
-            "INSERT INTO payments (user_id, amount, currency, charge_id, message, date) VALUES (?, ?, ?, ?, ?, ?)",
-            (user.id, amount, currency, charge_id, user_message, datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"))
-        )
-        await db.commit()
-
-    # ✅ Пайдаланушыға жауап
-    msg_to_user = f"✅ Төлем сәтті өтті!\n💰 Сома: {amount} ⭐"
-    if user_message:
-        msg_to_user += f"\n💌 Хабарлама: {user_message}"
-    await message.answer(msg_to_user)
-
-    # 👑 Әкімшіге хабар
-    msg_to_admin = (
-        f"🌟 Жаңа донат!\n"
-        f"👤 @{user.username or user.full_name} ({user.id})\n"
-        f"💰 {amount} ⭐\n"
-    )
-    if user_message:
-        msg_to_admin += f"💌 {user_message}\n"
-    msg_to_admin += f"Transaction ID: {charge_id}"
-
-    try:
-        await message.bot.send_message(ADMIN_ID, msg_to_admin)
-    except Exception:
-        logging.exception("Admin хабарламасын жіберу сәтсіз")
-
 # ------------------ Pre-checkout ------------------
 @router.pre_checkout_query()
 async def pre_checkout(pre_checkout_query: PreCheckoutQuery):
@@ -407,118 +339,110 @@ async def handle_successful_payment(message: Message):
     sp: SuccessfulPayment = message.successful_payment
     user = message.from_user
 
-    # payload алу (тәжірибелерде әртүрлі жерде болуы мүмкін)
-    payload = None
-    try:
-        payload = getattr(sp, "invoice_payload", None) or getattr(message, "invoice_payload", None)
-    except Exception:
-        payload = None
+    payload = getattr(sp, "invoice_payload", None)
 
     amount = sp.total_amount  # raw integer
     currency = sp.currency
     charge_id = sp.telegram_payment_charge_id
-    now_str = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
 
     product_id: Optional[int] = None
+    pending_id: Optional[int] = None
     user_message: Optional[str] = None
 
     # Егер payload өнімге жатса:
-    if payload and isinstance(payload, str) and payload.startswith("product:"):
+    if payload and payload.startswith("product:"):
         try:
             product_id = int(payload.split(":", 1)[1])
         except Exception:
             product_id = None
 
-    # Егер бұл донейт болса:
-    if payload and isinstance(payload, str) and payload.startswith("donation:"):
+    # Егер бұл донейт болса — сақталған хабарламаны алып, pending жазбасын тазалаймыз
+    if payload and payload.startswith("donation:"):
         try:
             pending_id = int(payload.split(":", 1)[1])
         except Exception:
             pending_id = None
         if pending_id:
-            async with aiosqlite.connect(DB_PATH) as db:
-                async with db.execute(
-                    "SELECT user_id, message FROM pending_donations WHERE id = ?", (pending_id,)
-                ) as cur:
-                    prow = await cur.fetchone()
-                if prow:
-                    # біз жай ғана сақтаулы хабарламаны пайдаланамыз
-                    user_message = prow[1]
-                # очистка pending (необязательно, бірақ ұқыпты)
-                await db.execute("DELETE FROM pending_donations WHERE id = ?", (pending_id,))
-                await db.commit()
-
-    # DB: payments енгізу
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT INTO payments (user_id, product_id, amount, currency, charge_id, date, message) VALUES (?, ?, ?, ?, ?, ?, ?)",
-            (user.id, product_id, amount, currency, charge_id, now_str, user_message),
-        )
-        # Егер өнім болса және оның duration_days > 0 болса — жазылым кестесіне жазу
-        if product_id:
-            async with db.execute("SELECT duration_days FROM products WHERE id = ? AND active = 1", (product_id,)) as cur:
-                prow = await cur.fetchone()
-            if prow:
-                duration_days = prow[0] or 0
-                if duration_days > 0:
-                    start = datetime.utcnow()
-                    expiry = start + timedelta(days=duration_days)
-                    await db.execute(
-                        "INSERT INTO subscriptions (user_id, product_id, start_date, expiry_date) VALUES (?, ?, ?, ?)",
-                        (user.id, product_id, start.strftime("%Y-%m-%d %H:%M:%S"), expiry.strftime("%Y-%m-%d %H:%M:%S")),
-                    )
-        await db.commit()
-
-    # Хабарлама сатып алушыға
-    msg = (
-        f"✅ Төлем сәтті өтті!\n"
-        f"Transaction ID: <code>{charge_id}</code>\n"
-        f"Сомасы (raw): <code>{amount}</code> {currency}\n"
+            user_message = await storage.pop_pending_donation(pending_id)
+
+    # DB: payments (+ жазылым немесе донор жиынтықтары) бір транзакцияда
+    display_name = f"@{user.username}" if user.username else user.full_name
+    expiry_ts = await storage.record_payment(
+        user.id, product_id, amount, currency, charge_id, user_message, now_ts(), display_name
     )
+    logger.info("Payment recorded", extra={"charge_id": charge_id})
+    if expiry_ts:
+        entitlements.grant(user.id, expiry_ts, product_id)
+    if not product_id:
+        await leaderboard.on_donation(user.id, display_name, amount)
+
+    # ✅ Пайдаланушыға жауап
+    msg_to_user = f"✅ Төлем сәтті өтті!\n💰 Сома: {amount} ⭐"
     if product_id:
-        msg += f"Сатып алынған өнім ID: <code>{product_id}</code>\n"
+        msg_to_user += f"\n📦 Өнім ID: <code>{product_id}</code>"
     if user_message:
-        msg += f"Сіздің хабарламаңыз: {user_message}\n"
+        msg_to_user += f"\n💌 Хабарлама: {user_message}"
+    await message.answer(msg_to_user)
 
-    await message.answer(msg)
+    # 👑 Әкімшіге хабар
+    msg_to_admin = (
+        f"{'🔔 Жаңа төлем' if product_id else '🌟 Жаңа донат!'}\n"
+        f"👤 @{user.username or user.full_name} ({user.id})\n"
+        f"💰 {amount} {currency}\n"
+    )
+    if product_id:
+        msg_to_admin += f"📦 product_id: {product_id}\n"
+    if user_message:
+        msg_to_admin += f"💌 {user_message}\n"
+    msg_to_admin += f"Transaction ID: {charge_id}"
 
-    # Әкімшіге хабарлау
     try:
-        uname = f"@{user.username}" if user.username else f"{user.full_name} ({user.id})"
-        await bot.send_message(
-            ADMIN_ID,
-            f"🔔 <b>Жаңа төлем</b>\n"
-            f"Пайдаланушы: {uname}\n"
-            f"product_id: {product_id} | amount: {amount} {currency}\n"
-            f"charge_id: {charge_id}\n"
-            + (f"message: {user_message}\n" if user_message else ""),
-        )
+        await message.bot.send_message(ADMIN_ID, msg_to_admin)
     except Exception:
-        logger.exception("Admin notify failed")
+        logger.exception("Admin notify failed", extra={"charge_id": charge_id})
 
 # ------------------ PREMIUM: пайдаланушы өз жазылымын тексеру ------------------
 @router.message(Command("premium"))
 async def cmd_premium(message: Message):
     uid = message.from_user.id
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute(
-            "SELECT expiry_date, product_id FROM subscriptions WHERE user_id = ? ORDER BY id DESC LIMIT 1", (uid,)
-        ) as cur:
-            row = await cur.fetchone()
+    row = await entitlements.get(uid)
 
     if not row:
         return await message.answer("Сізде белсенді жазылым жоқ. /pay арқылы жазылыңыз.")
 
-    expiry_str, product_id = row
-    expiry = datetime.strptime(expiry_str, "%Y-%m-%d %H:%M:%S")
-    now = datetime.utcnow()
-    if expiry > now:
-        remaining = expiry - now
-        days = remaining.days
+    expiry_ts, product_id = row
+    now = now_ts()
+    if expiry_ts and expiry_ts > now:
+        days = (expiry_ts - now) // 86400
         await message.answer(f"🎖️ Сізде белсенді жазылым бар (өнім ID:{product_id}). Қалған күндер: {days} күн.")
     else:
         await message.answer("Сіздің жазылым мерзімі аяқталған. Қайта жазылыңыз /pay арқылы.")
 
+# ------------------ TOP: донорлар рейтингі ------------------
+TOP_WINDOWS = {"day": (1, "бүгін"), "week": (7, "соңғы 7 күн"), "month": (30, "соңғы 30 күн")}
+
+@router.message(Command("top"))
+async def cmd_top(message: Message, command: CommandObject):
+    window = (command.args or "all").strip().lower()
+    if window == "all":
+        rows = await leaderboard.top()
+        title = "барлық уақыт"
+    elif window in TOP_WINDOWS:
+        days, title = TOP_WINDOWS[window]
+        rows = await leaderboard.top_window(days)
+    else:
+        return await message.answer("Пішім: /top [day|week|month|all]")
+
+    if not rows:
+        return await message.answer("Әзірге донаттар жоқ. /donate арқылы бірінші бол! ⭐")
+
+    medals = {1: "🥇", 2: "🥈", 3: "🥉"}
+    text = f"🏆 <b>Үздік қолдаушылар</b> ({title})\n\n"
+    for place, (uid, name, total) in enumerate(rows, start=1):
+        who = html.escape(name) if name else f"ID:{uid}"
+        text += f"{medals.get(place, f'{place}.')} {who} — {total} ⭐\n"
+    await message.answer(text)
+
 # ------------------ ӘКІМШІ: өнімдерді басқару (инлайн + командалар) ------------------
 def admin_only(user_id: int) -> bool:
     return user_id == ADMIN_ID
@@ -552,9 +476,7 @@ async def admin_products_list(callback: CallbackQuery):
     if not admin_only(callback.from_user.id):
         return await callback.answer("Құқың жоқ", show_alert=True)
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT id, title, amount, currency, duration_days, active FROM products ORDER BY id DESC") as cur:
-            rows = await cur.fetchall()
+    rows = await storage.list_products()
 
     if not rows:
         return await callback.message.edit_text("Өнімдер жоқ. /add_product арқылы қосыңыз.")
@@ -582,9 +504,7 @@ async def admin_product_edit_cb(callback: CallbackQuery):
     except:
         return await callback.answer("Қате ID", show_alert=True)
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT id, title, description, amount, currency, duration_days, active FROM products WHERE id = ?", (pid,)) as cur:
-            row = await cur.fetchone()
+    row = await storage.get_product(pid)
     if not row:
         return await callback.answer("Өнім табылмады.", show_alert=True)
 
@@ -604,14 +524,9 @@ async def admin_product_toggle(callback: CallbackQuery):
     if not admin_only(callback.from_user.id):
         return await callback.answer("Құқы жоқ", show_alert=True)
     pid = int(callback.data.split(":", 3)[-1])
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT active FROM products WHERE id = ?", (pid,)) as cur:
-            row = await cur.fetchone()
-        if not row:
-            return await callback.answer("Өнім табылмады.", show_alert=True)
-        new = 0 if row[0] else 1
-        await db.execute("UPDATE products SET active = ? WHERE id = ?", (new, pid))
-        await db.commit()
+    new = await storage.toggle_product(pid)
+    if new is None:
+        return await callback.answer("Өнім табылмады.", show_alert=True)
     await callback.answer("Өнім статусы жаңартылды.")
     await callback.message.edit_text("Өнім статусы өзгертілді. /admin қайта ашыңыз немесе 'Тізімге оралу' басыңыз.")
 
@@ -620,9 +535,7 @@ async def admin_product_delete(callback: CallbackQuery):
     if not admin_only(callback.from_user.id):
         return await callback.answer("Құқы жоқ", show_alert=True)
     pid = int(callback.data.split(":", 3)[-1])
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM products WHERE id = ?", (pid,))
-        await db.commit()
+    await storage.delete_product(pid)
     await callback.answer("Өнім жойылды.")
     await callback.message.edit_text("Өнім жойылды. /admin арқылы тізімді қайта ашыңыз.")
 
@@ -671,12 +584,7 @@ async def cmd_add_product(message: Message, command: CommandObject):
     except Exception as e:
         return await message.answer(f"Баптау қате: {e}\nПішім: /add_product Title|amount|duration_days|Description")
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT INTO products (title, description, amount, currency, duration_days, active) VALUES (?, ?, ?, ?, ?, 1)",
-            (title, description, amount, CURRENCY, duration),
-        )
-        await db.commit()
+    await storage.add_product(title, description, amount, CURRENCY, duration)
     await message.answer("✅ Өнім қосылды.")
 
 @router.message(Command("edit_product"))
@@ -696,12 +604,7 @@ async def cmd_edit_product(message: Message, command: CommandObject):
     except Exception as e:
         return await message.answer(f"Баптау қате: {e}\nПішім: /edit_product id|Title|amount|duration_days|Description")
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "UPDATE products SET title = ?, description = ?, amount = ?, duration_days = ? WHERE id = ?",
-            (title, description, amount, duration, pid),
-        )
-        await db.commit()
+    await storage.update_product(pid, title, description, amount, duration)
     await message.answer("✅ Өнім жаңартылды.")
 
 @router.message(Command("set_product_status"))
@@ -718,9 +621,7 @@ async def cmd_set_prod_status(message: Message, command: CommandObject):
     except Exception:
         return await message.answer("Қате баптау. /set_product_status <id> <0|1>", parse_mode=None)
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE products SET active = ? WHERE id = ?", (status, pid))
-        await db.commit()
+    await storage.set_product_active(pid, status)
     await message.answer("Статус өзгертілді.")
 
 @router.message(Command("delete_product"))
@@ -733,29 +634,32 @@ async def cmd_delete_product(message: Message, command: CommandObject):
         pid = int(command.args.strip())
     except:
         return await message.answer("ID сан болуы тиіс.")
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM products WHERE id = ?", (pid,))
-        await db.commit()
+    await storage.delete_product(pid)
     await message.answer("Өнім жойылды.")
 
 # -----------------------------------------
 # /stats пәрмені (тек әкімшіге)
 # -----------------------------------------
 @router.message(Command("stats"))
-async def cmd_stats(message: Message):
+async def cmd_stats(message: Message, command: CommandObject):
     if not admin_only(message.from_user.id):
         await message.answer("Бұл пәрмен тек әкімшіге арналған 🚫")
         return
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT COUNT(*), SUM(amount) FROM payments") as cur:
-            row = await cur.fetchone()
-    total_payments, total_amount = (row or (0, 0))
-    total_payments = total_payments or 0
-    total_amount = total_amount or 0
+    try:
+        start, end = parse_date_range(command.args)
+    except ValueError as e:
+        return await message.answer(f"Күн қате: {e}\nПішім: /stats [YYYY-MM-DD] [YYYY-MM-DD]", parse_mode=None)
+
+    total_payments, total_amount = await storage.payment_stats(start, end)
+
+    period = ""
+    if start is not None:
+        period = f"Кезең: {ts_to_str(start)[:10]} — {ts_to_str(end - 1)[:10]}\n"
 
     await message.answer(
         f"📊 <b>Статистика</b>\n"
+        f"{period}"
         f"Төлем саны: {total_payments}\n"
         f"Жалпы жиналған (raw): {total_amount} {CURRENCY}"
     )
@@ -768,38 +672,270 @@ async def cmd_mark_refund(message: Message, command: CommandObject):
     if not command.args:
         return await message.answer("Пішім: /mark_refund <charge_id>", parse_mode=None)
     cid = command.args.strip()
-    now = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE payments SET refunded = 1 WHERE charge_id = ?", (cid,))
-        await db.execute(
-            "INSERT INTO refunds (charge_id, admin_id, reason, date) VALUES (?, ?, ?, ?)",
-            (cid, message.from_user.id, "Manual refund marked", now),
-        )
-        await db.commit()
-        async with db.execute("SELECT user_id FROM payments WHERE charge_id = ?", (cid,)) as cur:
-            row = await cur.fetchone()
+    refunded = await storage.mark_refund(cid, message.from_user.id, "Manual refund marked", now_ts())
+    user_id = refunded[0] if refunded else None
+    if refunded:
+        entitlements.invalidate(user_id)
+        if refunded[1]:
+            # тек донат қайтарылса ғана донор жиынтығы өзгереді
+            leaderboard.on_refund(user_id)
     await message.answer(f"✅ {cid} жергілікті түрде қайтарылды (маркерленді).")
-    if row:
-        user_id = row[0]
+    if user_id:
         try:
             await bot.send_message(user_id, f"Сіздің төлеміңіз (ID: <code>{cid}</code>) әкімші тарапынан қайтарылған.")
         except Exception:
-            logger.exception("Notify user refund failed")
+            logger.exception("Notify user refund failed", extra={"charge_id": cid})
 
 # ------------------ Admin: refunds list ------------------
 @router.callback_query(F.data == "admin:refunds")
 async def admin_refunds_list(callback: CallbackQuery):
     if not admin_only(callback.from_user.id):
         return await callback.answer("Құқың жоқ", show_alert=True)
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT charge_id, admin_id, reason, date FROM refunds ORDER BY id DESC LIMIT 20") as cur:
-            rows = await cur.fetchall()
+    rows = await storage.get_refunds()
     if not rows:
         return await callback.message.edit_text("Қайтарулар жоқ.")
+    await callback.message.edit_text(_format_refunds(rows))
+
+@router.message(Command("refunds"))
+async def cmd_refunds(message: Message, command: CommandObject):
+    if not admin_only(message.from_user.id):
+        return await message.answer("Құқың жоқ")
+    try:
+        start, end = parse_date_range(command.args)
+    except ValueError as e:
+        return await message.answer(f"Күн қате: {e}\nПішім: /refunds [YYYY-MM-DD] [YYYY-MM-DD]", parse_mode=None)
+    rows = await storage.get_refunds(start, end)
+    if not rows:
+        return await message.answer("Бұл кезеңде қайтарулар жоқ.")
+    await message.answer(_format_refunds(rows))
+
+def _format_refunds(rows) -> str:
     text = "<b>📜 Қайтарулар (журнал):</b>\n\n"
-    for cid, aid, reason, date in rows:
-        text += f"{cid} — admin:{aid} — {reason} — {date}\n"
-    await callback.message.edit_text(text)
+    for cid, aid, reason, ts in rows:
+        text += f"{cid} — admin:{aid} — {reason} — {ts_to_str(ts)}\n"
+    return text
+
+# ------------------ BROADCAST: сегментке хабарлама тарату (admin only) ------------------
+BROADCAST_BATCH = 100  # күтудегі алушылар осы өлшеммен оқылады; күйі әр жіберуден кейін бірден жазылады
+BROADCAST_MAX_ATTEMPTS = 3  # желі қателері үшін; 429 әрекет ретінде саналмайды
+BROADCAST_RETRY_DELAY = 1.0  # желі қатесінен кейінгі кідіріс (секунд × әрекет нөмірі)
+
+class RateLimiter:
+    # Жіберулер арасында тұрақты интервал; 429 келсе — барлық жіберушілер бірге кідіреді
+    def __init__(self, rate: float):
+        self._interval = 1.0 / rate
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            delay = self._next - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next = max(self._next, loop.time()) + self._interval
+
+    def pause(self, seconds: float):
+        loop = asyncio.get_running_loop()
+        self._next = max(self._next, loop.time() + seconds)
+
+# Барлық таратулар бір лимитерді бөліседі: қатар жүрген таратулар бірге BROADCAST_RATE-тен аспайды
+broadcast_limiter = RateLimiter(BROADCAST_RATE)
+broadcast_sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+_broadcast_tasks: dict[int, asyncio.Task] = {}
+_notify_tasks: set[asyncio.Task] = set()  # create_task нәтижесі GC-ге түспеуі үшін
+
+async def _deliver(user_id: int, text: str) -> int:
+    async with broadcast_sem:
+        attempt = 0
+        while True:
+            await broadcast_limiter.wait()
+            try:
+                await bot.send_message(user_id, text)
+                return RCPT_SENT
+            except TelegramRetryAfter as e:
+                # flood control — кідіріп, сол алушыға қайта жібереміз
+                broadcast_limiter.pause(e.retry_after)
+            except TelegramForbiddenError:
+                # бот бұғатталған немесе пайдаланушы өшірілген
+                return RCPT_BLOCKED
+            except TelegramBadRequest:
+                # chat not found т.б. — қайталаудың мәні жоқ
+                return RCPT_FAILED
+            except TelegramAPIError as e:
+                # желі үзілуі / timeout / 5xx — уақытша қате, кідіріп қайталаймыз
+                attempt += 1
+                if attempt >= BROADCAST_MAX_ATTEMPTS:
+                    logger.error("Broadcast: send to %s failed after %s attempts: %r", user_id, attempt, e)
+                    return RCPT_FAILED
+                await asyncio.sleep(BROADCAST_RETRY_DELAY * attempt)
+
+async def _deliver_and_save(broadcast_id: int, user_id: int, text: str) -> int:
+    # күй жіберу аяқталған бойда жазылады — қайта іске қосылғанда жеткізілгендер қайта жіберілмейді
+    status = await _deliver(user_id, text)
+    await storage.set_recipient_statuses(broadcast_id, [(user_id, status)])
+    return status
+
+async def run_broadcast(broadcast_id: int):
+    counts = {RCPT_SENT: 0, RCPT_BLOCKED: 0, RCPT_FAILED: 0}
+    started = time.monotonic()
+
+    row = await storage.get_broadcast(broadcast_id)
+    if not row:
+        return
+    text = row[2]
+
+    last_uid = -1
+    while True:
+        batch = await storage.pending_recipients(broadcast_id, last_uid, BROADCAST_BATCH)
+        if not batch:
+            break
+        last_uid = batch[-1]
+
+        results = await asyncio.gather(*(_deliver_and_save(broadcast_id, uid, text) for uid in batch))
+        for st in results:
+            counts[st] += 1
+
+    await storage.finish_broadcast(broadcast_id, now_ts())
+
+    elapsed = time.monotonic() - started
+    processed = sum(counts.values())
+    rate = processed / elapsed if elapsed > 0 else 0.0
+    logger.info("Broadcast %s finished: %s recipients in %.1fs (%.1f msg/s)", broadcast_id, processed, elapsed, rate)
+    try:
+        await bot.send_message(
+            ADMIN_ID,
+            f"📣 <b>Тарату #{broadcast_id} аяқталды</b>\n"
+            f"Жіберілді: {counts[RCPT_SENT]}\n"
+            f"Бұғаттаған: {counts[RCPT_BLOCKED]}\n"
+            f"Қате: {counts[RCPT_FAILED]}\n"
+            f"Уақыт: {elapsed:.1f} сек ({rate:.1f} хабарлама/сек)",
+        )
+    except Exception:
+        logger.exception("Broadcast report failed")
+
+def start_broadcast_task(broadcast_id: int):
+    task = _broadcast_tasks.get(broadcast_id)
+    if task and not task.done():
+        return
+    task = asyncio.create_task(run_broadcast(broadcast_id))
+    _broadcast_tasks[broadcast_id] = task
+    task.add_done_callback(lambda t: _on_broadcast_done(broadcast_id, t))
+
+def _on_broadcast_done(broadcast_id: int, task: asyncio.Task):
+    _broadcast_tasks.pop(broadcast_id, None)
+    if task.cancelled():
+        return
+    exc = task.exception()
+    if exc is None:
+        return
+    # тарату 'running' күйінде қалады — келесі іске қосуда resume_broadcasts() жалғастырады
+    logger.error("Broadcast %s crashed", broadcast_id, exc_info=(type(exc), exc, exc.__traceback__))
+    notify = asyncio.create_task(_notify_broadcast_crash(broadcast_id, exc))
+    _notify_tasks.add(notify)
+    notify.add_done_callback(_notify_tasks.discard)
+
+async def _notify_broadcast_crash(broadcast_id: int, exc: BaseException):
+    try:
+        await bot.send_message(
+            ADMIN_ID,
+            f"⚠️ <b>Тарату #{broadcast_id} тоқтап қалды</b>\n"
+            f"Қате: <code>{html.escape(repr(exc)[:500])}</code>\n"
+            f"Қалған алушыларға бот қайта іске қосылғанда жалғасады.",
+        )
+    except Exception:
+        logger.exception("Broadcast crash report failed")
+
+# Іске қосылғанда үзілген таратуларды жалғастыру
+async def resume_broadcasts():
+    for bid in await storage.running_broadcasts():
+        logger.info("Resuming broadcast %s", bid)
+        start_broadcast_task(bid)
+
+@router.message(Command("broadcast"))
+async def cmd_broadcast(message: Message, command: CommandObject):
+    if not admin_only(message.from_user.id):
+        return await message.answer("Құқың жоқ")
+    usage = "Пішім: /broadcast <subscribers|payers|product:ID> <мәтін>"
+    if len((command.args or "").split(maxsplit=1)) < 2:
+        return await message.answer(usage, parse_mode=None)
+    # бот HTML parse_mode-пен жібереді: мәтінді html_text-тен аламыз — әкімшінің пішімдеуі сақталады,
+    # ал "<", "&" сияқты таңбалар экрандалады
+    _, segment, text = message.html_text.split(maxsplit=2)
+    try:
+        parse_segment(segment)
+    except ValueError as e:
+        return await message.answer(f"Сегмент қате: {e}\n{usage}", parse_mode=None)
+    try:
+        # алдымен әкімшінің өзіне алдын ала көрініс: Telegram мәтінді қабылдамаса, тарату басталмайды
+        await message.answer(text)
+    except TelegramBadRequest as e:
+        return await message.answer(f"Мәтін қате: {e.message}", parse_mode=None)
+    try:
+        broadcast_id, total = await storage.create_broadcast(segment, text, now_ts())
+    except ValueError as e:
+        return await message.answer(f"Сегмент қате: {e}\n{usage}", parse_mode=None)
+
+    await message.answer(f"📣 Тарату #{broadcast_id} басталды: {total} алушы.")
+    start_broadcast_task(broadcast_id)
+
+@router.message(Command("broadcast_status"))
+async def cmd_broadcast_status(message: Message, command: CommandObject):
+    if not admin_only(message.from_user.id):
+        return await message.answer("Құқың жоқ")
+    bid = None
+    if command.args:
+        try:
+            bid = int(command.args.strip())
+        except ValueError:
+            return await message.answer("ID сан болуы тиіс.")
+    row = await storage.get_broadcast(bid)
+    if not row:
+        return await message.answer("Тарату табылмады.")
+    bid, segment, _, status = row
+    counts = await storage.broadcast_counts(bid)
+
+    await message.answer(
+        f"📣 <b>Тарату #{bid}</b> ({segment}) — {status}\n"
+        f"Күтуде: {counts.get(RCPT_PENDING, 0)}\n"
+        f"Жіберілді: {counts.get(RCPT_SENT, 0)}\n"
+        f"Бұғаттаған: {counts.get(RCPT_BLOCKED, 0)}\n"
+        f"Қате: {counts.get(RCPT_FAILED, 0)}"
+    )
+
+# ------------------ PROFILE: тірі ботты профильдеу (admin only) ------------------
+PROFILE_MAX_SECONDS = 300
+_profile_lock = asyncio.Lock()
+
+@router.message(Command("profile"))
+async def cmd_profile(message: Message, command: CommandObject):
+    if not admin_only(message.from_user.id):
+        return await message.answer("Құқың жоқ")
+    try:
+        seconds = int((command.args or "10").strip())
+    except ValueError:
+        return await message.answer("Пішім: /profile <seconds>", parse_mode=None)
+    if not 1 <= seconds <= PROFILE_MAX_SECONDS:
+        return await message.answer(f"Ұзақтығы 1-{PROFILE_MAX_SECONDS} секунд болуы керек.")
+    if _profile_lock.locked():
+        return await message.answer("Профильдеу қазір жүріп жатыр.")
+
+    async with _profile_lock:
+        session = ProfileSession([router.message, router.callback_query, router.pre_checkout_query])
+        await message.answer(f"⏱️ Профильдеу басталды: {seconds} сек.")
+        try:
+            session.start()
+            await asyncio.sleep(seconds)
+        finally:
+            session.stop()
+
+    report = session.report()
+    await message.answer(f"<pre>{html.escape(report[:3900])}</pre>")
+    stamp = datetime.now(UTC).strftime("%Y%m%d-%H%M%S")
+    await message.answer_document(
+        BufferedInputFile(session.collapsed().encode(), filename=f"profile-{stamp}.folded"),
+        caption="Collapsed stacks (flamegraph.pl / speedscope)",
+    )
 
 # ------------------ Catch-all echo (сақтықпен) ------------------
 @router.message()
@@ -818,13 +954,19 @@ async def echo_catch_all(message: Message):
 # ------------------ Негізгі іске қосу ------------------
 async def main():
     logger.info("ДҚ қалпына келтіріліп жатыр...")
-    await init_db()
+    await storage.init()
+    await resume_broadcasts()
     logger.info("Бот іске қосылуға дайын.")
-    # Long polling
-    await dp.start_polling(bot)
+    try:
+        # Long polling
+        await dp.start_polling(bot)
+    finally:
+        await storage.close()
 
 if __name__ == "__main__":
     try:
         asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
         logger.info("Stopped by user")
+    finally:
+        log_listener.stop()
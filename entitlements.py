@@ -0,0 +1,78 @@
+# entitlements.py — Premium құқығын жылдам тексеру
+# user_id → (expiry_ts, product_id) картасы, шектелген LRU ретінде жадта ұсталады:
+# бірінші сұрауда storage-дан жүктеледі, кейін тексеру — бір dict lookup.
+# Сәтті төлем кезінде grant(), қайтару кезінде invalidate() арқылы жаңартылады.
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import CallbackQuery, Message, TelegramObject
+
+from storage import Storage, now_ts
+
+# Жазылымы жоқ пайдаланушылар да кэштеледі (әр жолы DB-ға бармау үшін)
+_NO_SUBSCRIPTION = (0, None)
+
+
+class Entitlements:
+    def __init__(self, storage: Storage, max_size: int = 10000):
+        self._storage = storage
+        self._max_size = max_size
+        self._cache: OrderedDict[int, tuple[int, Optional[int]]] = OrderedDict()
+
+    async def get(self, user_id: int) -> Optional[tuple[int, Optional[int]]]:
+        # (expiry_ts, product_id) — ең кеш аяқталатын жазылым, жоқ болса None
+        entry = self._cache.get(user_id)
+        if entry is None:
+            row = await self._storage.latest_subscription(user_id)
+            entry = (row[0] or 0, row[1]) if row else _NO_SUBSCRIPTION
+            self._put(user_id, entry)
+        else:
+            self._cache.move_to_end(user_id)
+        return None if entry is _NO_SUBSCRIPTION else entry
+
+    async def is_premium(self, user_id: int, now: Optional[int] = None) -> bool:
+        entry = await self.get(user_id)
+        return entry is not None and entry[0] > (now if now is not None else now_ts())
+
+    def grant(self, user_id: int, expiry_ts: int, product_id: Optional[int]):
+        # Кэште жоқ пайдаланушыны қоспаймыз: DB-да бұдан ұзағырақ жазылым болуы мүмкін,
+        # келесі сұрауда get() оны дұрыс жүктейді.
+        entry = self._cache.get(user_id)
+        if entry is not None and expiry_ts >= entry[0]:
+            self._put(user_id, (expiry_ts, product_id))
+
+    def invalidate(self, user_id: int):
+        self._cache.pop(user_id, None)
+
+    def _put(self, user_id: int, entry: tuple[int, Optional[int]]):
+        self._cache[user_id] = entry
+        self._cache.move_to_end(user_id)
+        if len(self._cache) > self._max_size:
+            self._cache.popitem(last=False)
+
+
+class PremiumMiddleware(BaseMiddleware):
+    # flags={"premium": True} белгіленген хэндлерлерді тек белсенді жазылымы барларға өткізеді:
+    #   @router.message(Command("secret"), flags={"premium": True})
+    def __init__(self, entitlements: Entitlements, denied_text: str):
+        self.entitlements = entitlements
+        self.denied_text = denied_text
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        if not get_flag(data, "premium"):
+            return await handler(event, data)
+        user = data.get("event_from_user")
+        if user and await self.entitlements.is_premium(user.id):
+            return await handler(event, data)
+        if isinstance(event, CallbackQuery):
+            await event.answer(self.denied_text, show_alert=True)
+        elif isinstance(event, Message):
+            await event.answer(self.denied_text)
+        return None
@@ -0,0 +1,386 @@
+# fake_telegram.py — жүктеме тесті үшін жергілікті Telegram Bot API (aiohttp)
+# Нақты Telegram-ға шықпай polling өткізу қабілетін өлшеу.
+#
+# Іске қосу:
+#   python fake_telegram.py --users 2000 --admin-id 1 --latency-ms 20 --rate-429 0.01
+#   TELEGRAM_API_BASE=http://127.0.0.1:8081 BOT_TOKEN=1:fake ADMIN_ID=1 STORAGE_BACKEND=memory python bot.py
+#
+# Сценарий: алдымен әкімші /add_product арқылы өнім қосады, содан кейін әр симуляцияланған
+# пайдаланушы /pay → buy → pre-checkout → successful_payment немесе
+# /donate → skip_message → donate:5 → pre-checkout → successful_payment жолынан өтеді.
+# Келесі қадам боттың жауабы (күтілген API әдісі) келгенде ғана жіберіледі — соңынан
+# updates/sec пен әр қадамның end-to-end кідірісі (p50/p90/p99) есептеледі.
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+from collections import Counter, defaultdict, deque
+from typing import Optional
+
+from aiohttp import web
+
+logger = logging.getLogger("fake_telegram")
+
+BOT_USER = {"id": 4242, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+USER_ID_BASE = 100000
+
+# қадам → (оны аяқтайтын Bot API әдісі)
+STEP_EXPECTS = {
+    "add_product": "sendMessage",
+    "pay": "sendMessage",
+    "buy": "sendInvoice",
+    "donate": "sendMessage",
+    "skip": "sendMessage",
+    "amount": "sendInvoice",
+    "pre_checkout": "answerPreCheckoutQuery",
+    "paid": "sendMessage",
+}
+
+FLOWS = {
+    "pay": ["pay", "buy", "pre_checkout", "paid"],
+    "donate": ["donate", "skip", "amount", "pre_checkout", "paid"],
+}
+
+
+class SimUser:
+    def __init__(self, uid: int, flow: list[str]):
+        self.uid = uid
+        self.flow = flow
+        self.pos = 0
+        self.product_id = 1
+        self.invoice: Optional[dict] = None
+        self.sent_at: Optional[float] = None  # ағымдағы қадам update-і ботқа берілген уақыт
+
+    @property
+    def step(self) -> Optional[str]:
+        return self.flow[self.pos] if self.pos < len(self.flow) else None
+
+
+def _percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class FakeTelegram:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.users: dict[int, SimUser] = {}
+        self.remaining = 0  # сценарийі аяқталмаған пайдаланушылар
+        self.queries: dict[str, int] = {}  # callback/pre-checkout id → user_id
+        self.updates: deque = deque()  # (update_id, user_id, update)
+        self.update_event = asyncio.Event()
+        self.next_update_id = 1
+        self.next_message_id = 1
+
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.method_calls: Counter = Counter()
+        self.injected_429 = 0
+        self.delivered = 0
+        self.first_delivery: Optional[float] = None
+        self.last_progress = time.perf_counter()
+        self.finished = asyncio.Event()
+
+    # ------------------ Update құрастыру ------------------
+    def _user(self, uid: int) -> dict:
+        return {"id": uid, "is_bot": False, "first_name": f"User{uid}", "username": f"user{uid}"}
+
+    def _chat(self, uid: int) -> dict:
+        return {"id": uid, "type": "private", "first_name": f"User{uid}"}
+
+    def _message(self, uid: int, sender: dict, **fields) -> dict:
+        self.next_message_id += 1
+        return {
+            "message_id": self.next_message_id,
+            "date": int(time.time()),
+            "chat": self._chat(uid),
+            "from": sender,
+            **fields,
+        }
+
+    def _text_update(self, u: SimUser, text: str) -> dict:
+        fields = {"text": text}
+        if text.startswith("/"):
+            fields["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"message": self._message(u.uid, self._user(u.uid), **fields)}
+
+    def _callback_update(self, u: SimUser, data: str) -> dict:
+        qid = f"cb{u.uid}:{u.pos}"
+        self.queries[qid] = u.uid
+        return {
+            "callback_query": {
+                "id": qid,
+                "from": self._user(u.uid),
+                "chat_instance": str(u.uid),
+                "data": data,
+                "message": self._message(u.uid, BOT_USER, text="..."),
+            }
+        }
+
+    def _build(self, u: SimUser) -> dict:
+        step = u.step
+        if step == "add_product":
+            return self._text_update(u, "/add_product Load test|1|30|fake_telegram.py")
+        if step == "pay":
+            return self._text_update(u, "/pay")
+        if step == "buy":
+            return self._callback_update(u, f"buy:{u.product_id}")
+        if step == "donate":
+            return self._text_update(u, "/donate")
+        if step == "skip":
+            return self._callback_update(u, "skip_message")
+        if step == "amount":
+            return self._callback_update(u, "donate:5")
+        inv = u.invoice or {"currency": "XTR", "total_amount": 1, "payload": f"product:{u.product_id}"}
+        if step == "pre_checkout":
+            qid = f"pcq{u.uid}:{u.pos}"
+            self.queries[qid] = u.uid
+            return {
+                "pre_checkout_query": {
+                    "id": qid,
+                    "from": self._user(u.uid),
+                    "currency": inv["currency"],
+                    "total_amount": inv["total_amount"],
+                    "invoice_payload": inv["payload"],
+                }
+            }
+        if step == "paid":
+            payment = {
+                "currency": inv["currency"],
+                "total_amount": inv["total_amount"],
+                "invoice_payload": inv["payload"],
+                "telegram_payment_charge_id": f"fake-{u.uid}-{self.next_update_id}",
+                "provider_payment_charge_id": f"prov-{u.uid}",
+            }
+            return {"message": self._message(u.uid, self._user(u.uid), successful_payment=payment)}
+        raise ValueError(step)
+
+    def enqueue(self, u: SimUser):
+        update = {"update_id": self.next_update_id, **self._build(u)}
+        self.updates.append((self.next_update_id, u.uid, update))
+        self.next_update_id += 1
+        u.sent_at = None
+        self.update_event.set()
+
+    def start_users(self):
+        for i in range(self.args.users):
+            uid = USER_ID_BASE + i
+            u = SimUser(uid, FLOWS["pay"] if i % 2 == 0 else FLOWS["donate"])
+            self.users[uid] = u
+            self.enqueue(u)
+        self.remaining = self.args.users
+
+    # ------------------ Бот жауаптарын өңдеу ------------------
+    def _complete(self, u: SimUser):
+        now = time.perf_counter()
+        self.latencies[u.step].append(now - u.sent_at)
+        self.last_progress = now
+        u.pos += 1
+        if u.step is not None:
+            self.enqueue(u)
+        elif u.flow[0] == "add_product":
+            # әкімші өнімді қосты — негізгі жүктемені бастаймыз
+            self.users.pop(u.uid, None)
+            self.start_users()
+        else:
+            self.remaining -= 1
+            if self.remaining == 0:
+                self.finished.set()
+
+    def _target_user(self, method: str, params: dict) -> Optional[SimUser]:
+        if method in ("answerCallbackQuery", "answerPreCheckoutQuery"):
+            qid = params.get("callback_query_id") or params.get("pre_checkout_query_id")
+            uid = self.queries.get(qid)
+        else:
+            try:
+                uid = int(params.get("chat_id"))
+            except (TypeError, ValueError):
+                return None
+        return self.users.get(uid)
+
+    def on_call(self, method: str, params: dict):
+        u = self._target_user(method, params)
+        if u is None or u.step is None or u.sent_at is None:
+            return
+        if method == "sendMessage" and u.step == "pay":
+            markup = json.loads(params.get("reply_markup") or "{}")
+            for row in markup.get("inline_keyboard", []):
+                for btn in row:
+                    if btn.get("callback_data", "").startswith("buy:"):
+                        u.product_id = int(btn["callback_data"].split(":", 1)[1])
+        if method == "sendInvoice":
+            prices = json.loads(params.get("prices") or "[]")
+            u.invoice = {
+                "currency": params.get("currency"),
+                "total_amount": sum(p["amount"] for p in prices),
+                "payload": params.get("payload"),
+            }
+        if method == "answerPreCheckoutQuery":
+            self.queries.pop(params.get("pre_checkout_query_id"), None)
+        if method == "answerCallbackQuery":
+            self.queries.pop(params.get("callback_query_id"), None)
+        if STEP_EXPECTS[u.step] == method:
+            self._complete(u)
+
+    def _result_for(self, method: str, params: dict):
+        if method == "getMe":
+            return BOT_USER
+        if method in ("sendMessage", "editMessageText", "sendInvoice", "sendDocument"):
+            self.next_message_id += 1
+            chat_id = int(params.get("chat_id") or 0)
+            result = {
+                "message_id": self.next_message_id,
+                "date": int(time.time()),
+                "chat": self._chat(chat_id),
+                "from": BOT_USER,
+            }
+            if method == "sendInvoice":
+                prices = json.loads(params.get("prices") or "[]")
+                result["invoice"] = {
+                    "title": params.get("title", ""),
+                    "description": params.get("description", ""),
+                    "start_parameter": params.get("start_parameter", ""),
+                    "currency": params.get("currency", "XTR"),
+                    "total_amount": sum(p["amount"] for p in prices),
+                }
+            else:
+                result["text"] = params.get("text", "")
+            return result
+        if method == "copyMessage":
+            self.next_message_id += 1
+            return {"message_id": self.next_message_id}
+        return True
+
+    # ------------------ HTTP ------------------
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.method_calls[method] += 1
+
+        if method == "getUpdates":
+            return web.json_response({"ok": True, "result": await self._get_updates(params)})
+
+        if self.args.latency_ms:
+            await asyncio.sleep(self.args.latency_ms / 1000)
+        if method not in ("getMe", "deleteWebhook") and self.rng.random() < self.args.rate_429:
+            self.injected_429 += 1
+            return web.json_response(
+                {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.args.retry_after}",
+                    "parameters": {"retry_after": self.args.retry_after},
+                },
+                status=429,
+            )
+
+        self.on_call(method, params)
+        return web.json_response({"ok": True, "result": self._result_for(method, params)})
+
+    async def _get_updates(self, params: dict) -> list[dict]:
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+
+        # offset-тен кіші update-тер бот тарапынан расталды
+        while self.updates and self.updates[0][0] < offset:
+            self.updates.popleft()
+        if not self.updates and timeout:
+            self.update_event.clear()
+            try:
+                await asyncio.wait_for(self.update_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                return []
+
+        now = time.perf_counter()
+        batch = []
+        for update_id, uid, update in list(self.updates)[:limit]:
+            u = self.users.get(uid)
+            if u is not None and u.sent_at is None:
+                u.sent_at = now
+                self.delivered += 1
+                if self.first_delivery is None:
+                    self.first_delivery = now
+            batch.append(update)
+        return batch
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.report())
+
+    # ------------------ Есеп ------------------
+    def report(self) -> dict:
+        elapsed = (self.last_progress - self.first_delivery) if self.first_delivery else 0.0
+        done = len(self.users) - self.remaining
+        steps = {}
+        for step, values in self.latencies.items():
+            steps[step] = {
+                "count": len(values),
+                "p50_ms": round(_percentile(values, 0.50) * 1000, 2),
+                "p90_ms": round(_percentile(values, 0.90) * 1000, 2),
+                "p99_ms": round(_percentile(values, 0.99) * 1000, 2),
+                "max_ms": round(max(values) * 1000, 2),
+            }
+        return {
+            "users": len(self.users),
+            "users_done": done,
+            "users_stalled": self.remaining,
+            "updates_delivered": self.delivered,
+            "elapsed_s": round(elapsed, 3),
+            "updates_per_s": round(self.delivered / elapsed, 1) if elapsed > 0 else 0.0,
+            "injected_429": self.injected_429,
+            "method_calls": dict(self.method_calls),
+            "steps": steps,
+        }
+
+    async def watch(self):
+        # барлығы аяқталғанша немесе прогресс --idle-timeout секунд тоқтағанша күтеміз
+        while not self.finished.is_set():
+            await asyncio.sleep(0.5)
+            if self.first_delivery and time.perf_counter() - self.last_progress > self.args.idle_timeout:
+                logger.warning("No progress for %ss — some users stalled", self.args.idle_timeout)
+                break
+
+
+async def run(args):
+    server = FakeTelegram(args)
+    app = web.Application()
+    app.router.add_get("/stats", server.handle_stats)
+    app.router.add_route("*", "/bot{token}/{method}", server.handle)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.port).start()
+    logger.info("Fake Bot API on http://%s:%s (users=%s)", args.host, args.port, args.users)
+
+    admin = SimUser(args.admin_id, ["add_product"])
+    server.users[admin.uid] = admin
+    server.enqueue(admin)
+
+    await server.watch()
+    print(json.dumps(server.report(), indent=2, ensure_ascii=False))
+    await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local fake Telegram Bot API for load testing bot.py")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--users", type=int, default=1000, help="simulated users")
+    parser.add_argument("--admin-id", type=int, required=True, help="must match the bot's ADMIN_ID")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="added latency per API call")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="probability of a 429 reply per call")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after sent with injected 429s")
+    parser.add_argument("--idle-timeout", type=float, default=10.0, help="stop after this many seconds without progress")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# leaderboard.py — донорлар рейтингі (/top)
+# Жалпы рейтинг: жадтағы top-K (user_id → (total, name)) + min-heap, әр донаттан кейін
+# инкременттік жаңартылады. Жиынтықтар storage-тағы donor_totals кестесінен алынады,
+# сондықтан төлемдер саны өссе де /top құны өзгермейді.
+# Уақыт терезесі (күн/апта/ай): donor_daily бакеттерінен, қысқа TTL кэшпен.
+import heapq
+import time
+from typing import Optional
+
+from storage import Storage, day_of, now_ts
+
+WINDOW_CACHE_TTL = 30  # секунд
+
+
+class Leaderboard:
+    def __init__(self, storage: Storage, k: int = 10):
+        self._storage = storage
+        self._k = k
+        self._top: dict[int, tuple[int, Optional[str]]] = {}
+        self._heap: list[tuple[int, int]] = []  # (total, user_id) — ескірген жазбалар жалқау түрде тасталады
+        self._loaded = False
+        self._window_cache: dict[int, tuple[float, list[tuple]]] = {}
+
+    async def top(self) -> list[tuple]:
+        # (user_id, display_name, total), total DESC
+        if not self._loaded:
+            await self._reload()
+        best = heapq.nlargest(self._k, ((t, uid) for uid, (t, _) in self._top.items()))
+        return [(uid, self._top[uid][1], t) for t, uid in best]
+
+    async def top_window(self, days: int) -> list[tuple]:
+        start_day = day_of(now_ts()) - days + 1
+        cached = self._window_cache.get(days)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+        rows = await self._storage.top_donors(self._k, start_day)
+        self._window_cache[days] = (time.monotonic() + WINDOW_CACHE_TTL, rows)
+        return rows
+
+    async def on_donation(self, user_id: int, display_name: Optional[str], amount: int):
+        # төлем DB-ға жазылғаннан кейін шақырылады
+        self._window_cache.clear()
+        if not self._loaded:
+            return
+        if user_id in self._top:
+            total = self._top[user_id][0] + amount
+        else:
+            row = await self._storage.donor_total(user_id)
+            if not row:
+                return
+            total = row[1]
+            if len(self._top) >= self._k and total <= self._floor()[0]:
+                return
+        self._set(user_id, total, display_name or self._top.get(user_id, (0, None))[1])
+        while len(self._top) > self._k:
+            _, uid = self._floor()
+            del self._top[uid]
+            heapq.heappop(self._heap)
+
+    def on_refund(self, user_id: int):
+        # рейтингтегі донордың сомасы азайса, K-шы орынға кім түсетінін тек DB біледі
+        self._window_cache.clear()
+        if user_id in self._top:
+            self._loaded = False
+
+    async def _reload(self):
+        rows = await self._storage.top_donors(self._k)
+        self._top = {}
+        self._heap = []
+        for uid, name, total in rows:
+            self._set(uid, total, name)
+        self._loaded = True
+
+    def _set(self, user_id: int, total: int, name: Optional[str]):
+        self._top[user_id] = (total, name)
+        heapq.heappush(self._heap, (total, user_id))
+        if len(self._heap) > 4 * self._k:
+            self._heap = [(t, uid) for uid, (t, _) in self._top.items()]
+            heapq.heapify(self._heap)
+
+    def _floor(self) -> tuple[int, int]:
+        # ең кіші (total, user_id); жаңартылған донорлардың ескі жазбаларын өткізіп жібереміз
+        while self._top.get(self._heap[0][1], (None,))[0] != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0]
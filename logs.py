@@ -0,0 +1,272 @@
+# logs.py — event loop-ты бұғаттамайтын логтау
+# Хэндлерлер жазған жазбалар тек кезекке салынады (QueueHandler), ал форматтау мен
+# дискке/консольге жазу бөлек ағында (QueueListener) орындалады.
+# Жазбалар JSON: update_id, user_id, handler, duration_ms, charge_id өрістерімен.
+# Қайталанатын қателер терезе ішінде басылады, кезек толса INFO жолдары таңдамалы жазылады.
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+update_id_var: ContextVar[Optional[int]] = ContextVar("update_id", default=None)
+user_id_var: ContextVar[Optional[int]] = ContextVar("user_id", default=None)
+handler_var: ContextVar[Optional[str]] = ContextVar("handler", default=None)
+
+# JSON-ға шығатын қосымша өрістер (extra={...} немесе contextvars арқылы)
+STRUCTURED_FIELDS = ("update_id", "user_id", "handler", "duration_ms", "charge_id", "suppressed", "dropped")
+
+
+class ContextFilter(logging.Filter):
+    # Ағымдағы update контекстін жазбаға қосады (extra арқылы берілгенін ауыстырмайды)
+    def filter(self, record: logging.LogRecord) -> bool:
+        for name, var in (("update_id", update_id_var), ("user_id", user_id_var), ("handler", handler_var)):
+            if getattr(record, name, None) is None:
+                setattr(record, name, var.get())
+        return True
+
+
+class DuplicateFilter(logging.Filter):
+    # Бірдей қате (logger, деңгей, хабарлама үлгісі, exception түрі) window секунд ішінде
+    # бір рет қана жазылады; қанша басылғаны келесі жазбада (suppressed өрісі) немесе терезе
+    # жабылғанда pop_expired() арқылы listener ағынынан жеке жазба ретінде шығады.
+    MAX_KEYS = 1000
+
+    def __init__(self, window: float):
+        super().__init__()
+        self.window = window
+        self._seen: dict[tuple, list] = {}  # key → [бірінші жазылған уақыт, басылғандар саны]
+        self._lock = threading.Lock()  # filter() — хэндлер ағыны, pop_expired() — listener ағыны
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.window <= 0 or (record.levelno < logging.ERROR and not record.exc_info):
+            return True
+        exc_type = record.exc_info[0].__name__ if record.exc_info and record.exc_info[0] else None
+        key = (record.name, record.levelno, str(record.msg), exc_type)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._seen.get(key)
+            if entry and now - entry[0] < self.window:
+                entry[1] += 1
+                return False
+            if entry and entry[1]:
+                record.suppressed = entry[1]
+            if len(self._seen) >= self.MAX_KEYS:
+                self._seen = {k: v for k, v in self._seen.items() if now - v[0] < self.window or v[1]}
+            self._seen[key] = [now, 0]
+        return True
+
+    def pop_expired(self, force: bool = False) -> list[logging.LogRecord]:
+        # Терезесі жабылған (force=True болса — барлық) кілттердің басылған санын жазбаға айналдырады
+        now = time.monotonic()
+        records = []
+        with self._lock:
+            for key, (first, count) in list(self._seen.items()):
+                if not count or (not force and now - first < self.window):
+                    continue
+                del self._seen[key]
+                name, levelno, msg, exc_type = key
+                records.append(logging.makeLogRecord({
+                    "name": name,
+                    "levelno": levelno,
+                    "levelname": logging.getLevelName(levelno),
+                    "msg": f"{count} duplicate records suppressed: {msg}" + (f" ({exc_type})" if exc_type else ""),
+                    "suppressed": count,
+                }))
+        return records
+
+
+class SamplingFilter(logging.Filter):
+    # Кезекте threshold-тан көп жазба жиналса (жүктеме), INFO жолдарының тек rate үлесі қалады
+    def __init__(self, rate: float, log_queue: queue.Queue, threshold: int):
+        super().__init__()
+        self.rate = rate
+        self.log_queue = log_queue
+        self.threshold = threshold
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno != logging.INFO or self.rate >= 1.0:
+            return True
+        if self.log_queue.qsize() < self.threshold:
+            return True
+        return random.random() < self.rate
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    # Кезек толса күтпейміз — жазбаны тастап, санын есептейміз
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Хабарлама мен traceback осында мәтінге айналады (args/exc_info басқа ағынға өтпейді),
+        # ал JSON форматтау listener ағынында орындалады.
+        record = logging.makeLogRecord(record.__dict__)
+        record.message = record.getMessage()
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+class DropReportingListener(logging.handlers.QueueListener):
+    # Listener ағынынан жоғалған жазбалар туралы хабарлайды: кезек толып тасталғандар саны (WARNING)
+    # және DuplicateFilter басқан қайталаулар саны. Келесі жазбаны өңдеу алдында, кезек
+    # FLUSH_INTERVAL бойы бос тұрса және stop() кезінде тексеріледі.
+    FLUSH_INTERVAL = 1.0
+
+    def __init__(
+        self,
+        log_queue: queue.Queue,
+        queue_handler: NonBlockingQueueHandler,
+        *handlers,
+        dedup: Optional[DuplicateFilter] = None,
+        **kwargs,
+    ):
+        super().__init__(log_queue, *handlers, **kwargs)
+        self.queue_handler = queue_handler
+        self.dedup = dedup
+        self._reported = 0
+
+    def dequeue(self, block: bool):
+        # тыныштықта да терезесі жабылған басылу сандары шығуы үшін кезекті timeout-пен күтеміз
+        while True:
+            try:
+                return self.queue.get(block, timeout=self.FLUSH_INTERVAL if block else None)
+            except queue.Empty:
+                if not block:
+                    raise
+                self._report_pending()
+
+    def handle(self, record: logging.LogRecord):
+        self._report_pending()
+        super().handle(record)
+
+    def stop(self):
+        super().stop()
+        self._report_pending(force=True)
+
+    def _report_pending(self, force: bool = False):
+        self._report_dropped()
+        if self.dedup is not None:
+            for record in self.dedup.pop_expired(force):
+                super().handle(record)
+
+    def _report_dropped(self):
+        dropped = self.queue_handler.dropped - self._reported
+        if dropped <= 0:
+            return
+        self._reported += dropped
+        record = logging.makeLogRecord({
+            "name": __name__,
+            "levelno": logging.WARNING,
+            "levelname": "WARNING",
+            "msg": f"log queue full: {dropped} records dropped",
+            "dropped": dropped,
+        })
+        super().handle(record)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for name in STRUCTURED_FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                data[name] = value
+        if record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def setup_logging(
+    level: str = "INFO",
+    queue_size: int = 10000,
+    dedup_window: float = 60.0,
+    sample_rate: float = 1.0,
+    sample_threshold: int = 1000,
+    log_file: Optional[str] = None,
+) -> DropReportingListener:
+    # Түбір логгерді кезекке бағыттап, listener-ді іске қосады; тоқтату — listener.stop()
+    log_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    dedup = DuplicateFilter(dedup_window)
+    queue_handler.addFilter(dedup)
+    queue_handler.addFilter(SamplingFilter(sample_rate, log_queue, sample_threshold))
+
+    output: logging.Handler = logging.FileHandler(log_file, encoding="utf-8") if log_file else logging.StreamHandler(sys.stderr)
+    output.setFormatter(JsonFormatter())
+
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    listener = DropReportingListener(log_queue, queue_handler, output, dedup=dedup, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+class UpdateContextMiddleware(BaseMiddleware):
+    # dp.update outer middleware: update_id/user_id контекстін орнатып, өңдеу уақытын өлшейді
+    def __init__(self, logger: logging.Logger):
+        self.logger = logger
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        tokens = (
+            update_id_var.set(getattr(event, "update_id", None)),
+            user_id_var.set(user.id if user else None),
+            handler_var.set(None),
+        )
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            duration_ms = round((time.perf_counter() - started) * 1000, 2)
+            self.logger.info("update handled", extra={"duration_ms": duration_ms})
+            for var, token in zip((update_id_var, user_id_var, handler_var), tokens):
+                var.reset(token)
+
+
+class HandlerNameMiddleware(BaseMiddleware):
+    # router.<event> inner middleware: қай хэндлер таңдалғанын контекстке жазады
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        if handler_object is not None:
+            handler_var.set(getattr(handler_object.callback, "__name__", None))
+        return await handler(event, data)
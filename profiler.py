@@ -0,0 +1,174 @@
+# profiler.py — тірі ботты қайта іске қоспай профильдеу (/profile <seconds>)
+# Тек терезе ішінде жұмыс істейді, одан тыс ештеңе іске қосылмайды:
+#   * sampling профайлер: бөлек ағын event loop ағынының стегін interval сайын оқиды
+#     (sys._current_frames) — хэндлер кодына еш өзгеріс енгізбейді;
+#   * loop-lag watchdog: loop ішіндегі heartbeat кешіксе, сол сәттегі стек жазылады — asyncio debug
+#     режимінсіз (ол әр call_soon-да стек жинайды, профильдің өзін баяулатады);
+#   * хэндлер уақыты: терезе кезінде ғана тіркелетін inner middleware.
+# Нәтиже: ең көп уақыт алған функциялар есебі + collapsed-stack файлы (flamegraph.pl / speedscope).
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Any, Awaitable, Callable, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+
+class StackSampler:
+    # lag_threshold берілсе — watchdog: loop ағыны beat()-ті шақырмай тұрған уақыт шектен асса,
+    # сол кездегі стек (loop-ты не бұғаттап тұр) келесі beat()-те кідіріс ұзақтығымен бірге сақталады
+    def __init__(self, thread_id: int, interval: float, lag_threshold: Optional[float] = None):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.lag_threshold = lag_threshold
+        self.stacks: Counter = Counter()  # "root;...;leaf" → үлгілер саны
+        self.samples = 0
+        self.slow: list[tuple[float, str]] = []  # (loop бұғатталған секунд, стек)
+        self._last_beat = time.perf_counter()
+        self._lag_stack: Optional[str] = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def beat(self):
+        # loop ағынынан interval сайын шақырылады
+        now = time.perf_counter()
+        lag = now - self._last_beat - self.interval
+        self._last_beat = now
+        stack, self._lag_stack = self._lag_stack, None
+        if stack is not None and self.lag_threshold is not None and lag > self.lag_threshold:
+            self.slow.append((lag, stack))
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            stack.reverse()
+            joined = ";".join(stack)
+            self.stacks[joined] += 1
+            self.samples += 1
+            if (
+                self.lag_threshold is not None
+                and self._lag_stack is None
+                and time.perf_counter() - self._last_beat - self.interval > self.lag_threshold
+            ):
+                self._lag_stack = joined
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def top_functions(self, limit: int) -> tuple[list[tuple[str, int]], list[tuple[str, int]]]:
+        # (self уақыты бойынша, inclusive уақыты бойынша)
+        own: Counter = Counter()
+        total: Counter = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            own[frames[-1]] += count
+            for name in set(frames):
+                total[name] += count
+        return own.most_common(limit), total.most_common(limit)
+
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    def __init__(self):
+        self.timings: dict[str, list[float]] = defaultdict(list)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = getattr(handler_object.callback, "__name__", "?") if handler_object else "?"
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            self.timings[name].append(time.perf_counter() - started)
+
+
+class ProfileSession:
+    # Бір профильдеу терезесі: start() → await asyncio.sleep(...) → stop() → report()/collapsed()
+    def __init__(self, observers: list, interval: float = 0.005, slow_callback: float = 0.05):
+        self.observers = observers  # router.message, router.callback_query, ...
+        self.interval = interval
+        self.slow_callback = slow_callback
+        self.started = 0.0
+        self.duration = 0.0
+        self.sampler: Optional[StackSampler] = None
+        self.timing = HandlerTimingMiddleware()
+        self._registered: list = []
+        self._beat_handle: Optional[asyncio.TimerHandle] = None
+
+    # start() ортасында құласа да stop() тек орындалған қадамдарды ғана кері қайтарады
+    def start(self):
+        self.started = time.perf_counter()
+        for observer in self.observers:
+            observer.middleware.register(self.timing)
+            self._registered.append(observer)
+        # event loop ағыны — осы coroutine орындалып жатқан ағын
+        sampler = StackSampler(threading.get_ident(), self.interval, self.slow_callback)
+        sampler.start()
+        self.sampler = sampler
+        self._heartbeat()
+
+    def _heartbeat(self):
+        self.sampler.beat()
+        self._beat_handle = asyncio.get_running_loop().call_later(self.interval, self._heartbeat)
+
+    def stop(self):
+        if self._beat_handle is not None:
+            self._beat_handle.cancel()
+            self._beat_handle = None
+        if self.sampler is not None:
+            self.sampler.stop()
+        while self._registered:
+            self._registered.pop().middleware.unregister(self.timing)
+        self.duration = time.perf_counter() - self.started
+
+    def collapsed(self) -> str:
+        return self.sampler.collapsed()
+
+    def report(self, limit: int = 15) -> str:
+        own, total = self.sampler.top_functions(limit)
+        samples = self.sampler.samples or 1
+        lines = [
+            f"Window: {self.duration:.1f}s, samples: {self.sampler.samples} (every {self.interval * 1000:.0f} ms)",
+            "",
+            "Top functions (self):",
+        ]
+        lines += [f"  {count * 100 / samples:5.1f}%  {name}" for name, count in own]
+        lines += ["", "Top functions (inclusive):"]
+        lines += [f"  {count * 100 / samples:5.1f}%  {name}" for name, count in total]
+
+        lines += ["", "Handlers (count / avg ms / max ms):"]
+        by_total = sorted(self.timing.timings.items(), key=lambda kv: sum(kv[1]), reverse=True)
+        for name, values in by_total[:limit]:
+            lines.append(f"  {name}: {len(values)} / {sum(values) * 1000 / len(values):.1f} / {max(values) * 1000:.1f}")
+        if not by_total:
+            lines.append("  (no updates)")
+
+        # loop бұғатталған сәттегі стектің соңғы (ең ішкі) кадрлары — нақты не бұғаттағаны
+        lines += ["", f"Loop blocked (> {self.slow_callback * 1000:.0f} ms): {len(self.sampler.slow)}"]
+        slowest = sorted(self.sampler.slow, key=lambda r: r[0], reverse=True)[:5]
+        for seconds, stack in slowest:
+            frames = stack.split(";")[-3:]
+            lines.append(f"  {seconds * 1000:7.0f} ms  {' < '.join(reversed(frames))[:160]}")
+        return "\n".join(lines)
@@ -0,0 +1,894 @@
+# storage.py — деректер қоймасы (репозиторий қабаты)
+# Барлық SQL осы жерде: bot.py хэндлерлері тек Storage әдістерін шақырады.
+# STORAGE_BACKEND=sqlite (әдепкі) — aiosqlite, STORAGE_BACKEND=memory — тесттер/бенчмарктар үшін жадта.
+import asyncio
+import bisect
+import heapq
+import logging
+import time
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, UTC
+from typing import Optional
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+# ------------------ Helper: уақыт (UTC epoch секундтары) ------------------
+DATE_FMT = "%Y-%m-%d %H:%M:%S"
+
+def now_ts() -> int:
+    return int(time.time())
+
+def ts_to_str(ts: Optional[int]) -> str:
+    if ts is None:
+        return "-"
+    return datetime.fromtimestamp(ts, UTC).strftime(DATE_FMT)
+
+# Лидерборд күндік бакеттері: UTC күн нөмірі
+def day_of(ts: int) -> int:
+    return ts // 86400
+
+def _in_range(ts: Optional[int], start: Optional[int], end: Optional[int]) -> bool:
+    if ts is None:
+        return start is None and end is None
+    return (start is None or ts >= start) and (end is None or ts < end)
+
+# ------------------ Broadcast сегменттері ------------------
+# 'subscribers' | 'payers' | 'product:<id>' → (түрі, product_id)
+def parse_segment(segment: str) -> tuple[str, Optional[int]]:
+    if segment in ("subscribers", "payers"):
+        return segment, None
+    if segment.startswith("product:"):
+        return "product", int(segment.split(":", 1)[1])
+    raise ValueError(f"белгісіз сегмент: {segment}")
+
+# Алушы күйлері (broadcast_recipients.status)
+RCPT_PENDING, RCPT_SENT, RCPT_BLOCKED, RCPT_FAILED = 0, 1, 2, 3
+
+# ------------------ Интерфейс ------------------
+# Жолдар aiosqlite сияқты кортеж ретінде қайтарылады — екі backend бірдей пішінді береді.
+class Storage(ABC):
+    async def init(self):
+        pass
+
+    async def close(self):
+        pass
+
+    # products
+    @abstractmethod
+    async def get_active_products(self, limit: int = 50) -> list[tuple]:
+        # (id, title, description, amount, currency, duration_days)
+        ...
+
+    @abstractmethod
+    async def get_product(self, pid: int, active_only: bool = False) -> Optional[tuple]:
+        # (id, title, description, amount, currency, duration_days, active)
+        ...
+
+    @abstractmethod
+    async def list_products(self) -> list[tuple]:
+        # (id, title, amount, currency, duration_days, active), id DESC
+        ...
+
+    @abstractmethod
+    async def add_product(self, title: str, description: str, amount: int, currency: str, duration_days: int) -> int:
+        ...
+
+    @abstractmethod
+    async def update_product(self, pid: int, title: str, description: str, amount: int, duration_days: int):
+        ...
+
+    @abstractmethod
+    async def set_product_active(self, pid: int, active: int):
+        ...
+
+    @abstractmethod
+    async def toggle_product(self, pid: int) -> Optional[int]:
+        # жаңа статус, өнім жоқ болса None
+        ...
+
+    @abstractmethod
+    async def delete_product(self, pid: int):
+        ...
+
+    # pending donations
+    @abstractmethod
+    async def add_pending_donation(self, user_id: int, amount: int, message: Optional[str], created_ts: int) -> int:
+        ...
+
+    @abstractmethod
+    async def pop_pending_donation(self, pending_id: int) -> Optional[str]:
+        # сақталған хабарламаны қайтарып, жазбаны өшіреді
+        ...
+
+    # payments + subscriptions
+    @abstractmethod
+    async def record_payment(
+        self,
+        user_id: int,
+        product_id: Optional[int],
+        amount: int,
+        currency: str,
+        charge_id: str,
+        message: Optional[str],
+        ts: int,
+        display_name: Optional[str] = None,
+    ) -> Optional[int]:
+        # Бір транзакцияда: төлем + (өнімнің мерзімі болса) жазылым + (донат болса) донор жиынтықтары.
+        # Жазылым expiry_ts-ін қайтарады.
+        ...
+
+    @abstractmethod
+    async def payment_stats(self, start: Optional[int] = None, end: Optional[int] = None) -> tuple[int, int]:
+        # (саны, сомасы)
+        ...
+
+    @abstractmethod
+    async def latest_subscription(self, user_id: int) -> Optional[tuple]:
+        # (expiry_ts, product_id) — ең кеш аяқталатын жазылым
+        ...
+
+    # refunds
+    @abstractmethod
+    async def mark_refund(self, charge_id: str, admin_id: int, reason: str, ts: int) -> Optional[tuple[int, bool]]:
+        # төлемді refunded деп белгілеп, журналға жазады, осы төлеммен ашылған жазылымды ts-те жабады;
+        # (төлеушінің user_id-і, донор жиынтықтары азайды ма) қайтарады, төлем табылмаса None
+        ...
+
+    @abstractmethod
+    async def get_refunds(self, start: Optional[int] = None, end: Optional[int] = None, limit: int = 20) -> list[tuple]:
+        # (charge_id, admin_id, reason, ts), ts DESC
+        ...
+
+    # donor leaderboard (тек донаттар: product_id IS NULL, legacy емес, қайтарылғандарсыз)
+    @abstractmethod
+    async def top_donors(self, limit: int, start_day: Optional[int] = None) -> list[tuple]:
+        # (user_id, display_name, total), total DESC; start_day берілсе — сол күннен бергі донаттар
+        ...
+
+    @abstractmethod
+    async def donor_total(self, user_id: int) -> Optional[tuple]:
+        # (display_name, total)
+        ...
+
+    # broadcasts
+    @abstractmethod
+    async def create_broadcast(self, segment: str, text: str, ts: int) -> tuple[int, int]:
+        # (broadcast_id, алушылар саны); сегмент қате болса ValueError
+        ...
+
+    @abstractmethod
+    async def get_broadcast(self, broadcast_id: Optional[int] = None) -> Optional[tuple]:
+        # (id, segment, text, status); id берілмесе — ең соңғысы
+        ...
+
+    @abstractmethod
+    async def broadcast_counts(self, broadcast_id: int) -> dict[int, int]:
+        ...
+
+    @abstractmethod
+    async def pending_recipients(self, broadcast_id: int, after_user_id: int, limit: int) -> list[int]:
+        ...
+
+    @abstractmethod
+    async def set_recipient_statuses(self, broadcast_id: int, results: list[tuple[int, int]]):
+        # results: [(user_id, status), ...]
+        ...
+
+    @abstractmethod
+    async def finish_broadcast(self, broadcast_id: int, ts: int):
+        ...
+
+    @abstractmethod
+    async def running_broadcasts(self) -> list[int]:
+        ...
+
+
+# ------------------ SQLite (aiosqlite) ------------------
+SCHEMA = [
+    # products: ұсыныстар/жазылымдар/пакеттер
+    """
+    CREATE TABLE IF NOT EXISTS products (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        title TEXT NOT NULL,
+        description TEXT,
+        amount INTEGER NOT NULL,
+        currency TEXT NOT NULL,
+        duration_days INTEGER DEFAULT 0,
+        active INTEGER DEFAULT 1
+    )
+    """,
+    # payments: нақты төлем жазбасы (қолдау хабарламасы үшін message бағаны қосылды)
+    """
+    CREATE TABLE IF NOT EXISTS payments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        product_id INTEGER,
+        amount INTEGER NOT NULL,
+        currency TEXT,
+        charge_id TEXT UNIQUE,
+        date TEXT,
+        refunded INTEGER DEFAULT 0,
+        message TEXT,
+        ts INTEGER,
+        legacy INTEGER DEFAULT 0
+    )
+    """,
+    # subscriptions: пайдаланушы жазылымдары
+    """
+    CREATE TABLE IF NOT EXISTS subscriptions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        product_id INTEGER,
+        start_date TEXT,
+        expiry_date TEXT,
+        start_ts INTEGER,
+        expiry_ts INTEGER,
+        charge_id TEXT
+    )
+    """,
+    # refunds: локал журнал
+    """
+    CREATE TABLE IF NOT EXISTS refunds (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        charge_id TEXT,
+        admin_id INTEGER,
+        reason TEXT,
+        date TEXT,
+        ts INTEGER
+    )
+    """,
+    # pending_donations: төлемге дейінгі донейт хабарламаларын сақтау (payload-қа сілтеме жасаймыз)
+    """
+    CREATE TABLE IF NOT EXISTS pending_donations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        amount INTEGER NOT NULL,
+        message TEXT,
+        created_at TEXT,
+        created_ts INTEGER
+    )
+    """,
+    # broadcasts: әкімші таратулары (/broadcast)
+    """
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        segment TEXT NOT NULL,
+        text TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'running',
+        created_ts INTEGER,
+        finished_ts INTEGER
+    )
+    """,
+    # broadcast_recipients: әр алушының күйі (0 — күтуде, 1 — жіберілді, 2 — бұғаттаған, 3 — қате)
+    """
+    CREATE TABLE IF NOT EXISTS broadcast_recipients (
+        broadcast_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        status INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (broadcast_id, user_id)
+    ) WITHOUT ROWID
+    """,
+    # donor_totals: әр донордың жалпы сомасы (төлем транзакциясында жаңартылады)
+    """
+    CREATE TABLE IF NOT EXISTS donor_totals (
+        user_id INTEGER PRIMARY KEY,
+        display_name TEXT,
+        total INTEGER NOT NULL DEFAULT 0,
+        donations INTEGER NOT NULL DEFAULT 0,
+        last_ts INTEGER
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_donor_totals_total ON donor_totals (total DESC)",
+    # donor_daily: күндік жиынтықтар — уақыт терезесі бойынша лидерборд үшін
+    """
+    CREATE TABLE IF NOT EXISTS donor_daily (
+        day INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        total INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, user_id)
+    ) WITHOUT ROWID
+    """,
+]
+
+# ------------------ Migration: TEXT күндерден INTEGER epoch бағандарына ------------------
+# (кесте, ескі TEXT баған, жаңа INTEGER баған) — ескі DB-лар үшін баған қосып, толтырамыз
+EPOCH_COLUMNS = [
+    ("payments", "date", "ts"),
+    ("subscriptions", "start_date", "start_ts"),
+    ("subscriptions", "expiry_date", "expiry_ts"),
+    ("refunds", "date", "ts"),
+    ("pending_donations", "created_at", "created_ts"),
+]
+
+EPOCH_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_payments_ts ON payments (ts)",
+    "CREATE INDEX IF NOT EXISTS idx_payments_user_ts ON payments (user_id, ts)",
+    "CREATE INDEX IF NOT EXISTS idx_subscriptions_user_expiry ON subscriptions (user_id, expiry_ts)",
+    "CREATE INDEX IF NOT EXISTS idx_refunds_ts ON refunds (ts)",
+    "CREATE INDEX IF NOT EXISTS idx_pending_donations_created_ts ON pending_donations (created_ts)",
+]
+
+async def _migrate_epoch_columns(db):
+    for table, text_col, ts_col in EPOCH_COLUMNS:
+        async with db.execute(f"PRAGMA table_info({table})") as cur:
+            columns = {row[1] for row in await cur.fetchall()}
+        if ts_col not in columns:
+            await db.execute(f"ALTER TABLE {table} ADD COLUMN {ts_col} INTEGER")
+        # "%Y-%m-%d %H:%M:%S" жолдары UTC ретінде сақталған — strftime('%s') оларды epoch-қа айналдырады
+        await db.execute(
+            f"UPDATE {table} SET {ts_col} = CAST(strftime('%s', {text_col}) AS INTEGER) "
+            f"WHERE {ts_col} IS NULL AND {text_col} IS NOT NULL"
+        )
+    for stmt in EPOCH_INDEXES:
+        await db.execute(stmt)
+
+# subscriptions.charge_id: қайтарылған төлемнің жазылымын табу үшін
+async def _migrate_subscription_charge(db):
+    async with db.execute("PRAGMA table_info(subscriptions)") as cur:
+        columns = {row[1] for row in await cur.fetchall()}
+    if "charge_id" not in columns:
+        await db.execute("ALTER TABLE subscriptions ADD COLUMN charge_id TEXT")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_charge ON subscriptions (charge_id)")
+
+# payments.legacy: бұрынғы нұсқа өнім сатып алуларын да product_id-сіз жазған, сондықтан хабарламасыз
+# ескі жолдарды донаттан ажырату мүмкін емес — олар лидербордқа кірмейді (legacy = 1)
+async def _migrate_payment_legacy(db):
+    async with db.execute("PRAGMA table_info(payments)") as cur:
+        columns = {row[1] for row in await cur.fetchall()}
+    if "legacy" not in columns:
+        await db.execute("ALTER TABLE payments ADD COLUMN legacy INTEGER DEFAULT 0")
+        await db.execute("UPDATE payments SET legacy = 1 WHERE product_id IS NULL AND message IS NULL")
+
+# Бұрыннан бар донаттардан donor_* кестелерін бір рет толтыру (тек хабарламасы бар — нақты донат екені белгілі жолдар)
+async def _backfill_donor_totals(db):
+    async with db.execute("SELECT EXISTS (SELECT 1 FROM donor_totals)") as cur:
+        if (await cur.fetchone())[0]:
+            return
+    await db.execute(
+        "INSERT INTO donor_totals (user_id, total, donations, last_ts) "
+        "SELECT user_id, SUM(amount), COUNT(*), MAX(ts) FROM payments "
+        "WHERE product_id IS NULL AND legacy = 0 AND refunded = 0 GROUP BY user_id"
+    )
+    await db.execute(
+        "INSERT INTO donor_daily (day, user_id, total) "
+        "SELECT ts / 86400, user_id, SUM(amount) FROM payments "
+        "WHERE product_id IS NULL AND legacy = 0 AND refunded = 0 AND ts IS NOT NULL GROUP BY ts / 86400, user_id"
+    )
+
+# Индекс бойынша іздеуге арналған WHERE бөлігі: start <= column < end
+def range_clause(column: str, start: Optional[int], end: Optional[int]) -> tuple[str, tuple]:
+    conds, params = [], []
+    if start is not None:
+        conds.append(f"{column} >= ?")
+        params.append(start)
+    if end is not None:
+        conds.append(f"{column} < ?")
+        params.append(end)
+    return (" WHERE " + " AND ".join(conds)) if conds else "", tuple(params)
+
+SEGMENT_QUERIES = {
+    "subscribers": "SELECT DISTINCT user_id FROM subscriptions WHERE expiry_ts > ?",
+    "payers": "SELECT DISTINCT user_id FROM payments",
+    "product": "SELECT DISTINCT user_id FROM payments WHERE product_id = ?",
+}
+
+class SqliteStorage(Storage):
+    # Бір тұрақты байланыс: sqlite3 дайындалған statement-терді байланыс деңгейінде кэштейді,
+    # сондықтан тұрақты SQL жолдары әр шақыруда қайта компиляцияланбайды.
+    # Жазулар _tx() ішінде: бір транзакция, _lock арқылы кезекпен, қате болса rollback.
+    def __init__(self, path: str):
+        self.path = path
+        self._db: Optional[aiosqlite.Connection] = None
+        self._lock = asyncio.Lock()
+
+    async def init(self):
+        self._db = await aiosqlite.connect(self.path)
+        await self._db.execute("PRAGMA journal_mode=WAL")
+        await self._db.execute("PRAGMA synchronous=NORMAL")
+        for stmt in SCHEMA:
+            await self._db.execute(stmt)
+        await _migrate_epoch_columns(self._db)
+        await _migrate_subscription_charge(self._db)
+        await _migrate_payment_legacy(self._db)
+        await _backfill_donor_totals(self._db)
+        await self._db.commit()
+        logger.info("DB initialized.")
+
+    async def close(self):
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    async def _fetchone(self, sql: str, params: tuple = ()):
+        async with self._db.execute(sql, params) as cur:
+            return await cur.fetchone()
+
+    async def _fetchall(self, sql: str, params: tuple = ()):
+        async with self._db.execute(sql, params) as cur:
+            return await cur.fetchall()
+
+    @asynccontextmanager
+    async def _tx(self):
+        async with self._lock:
+            try:
+                yield self._db
+                await self._db.commit()
+            except BaseException:
+                await self._db.rollback()
+                raise
+
+    async def _write(self, sql: str, params: tuple = ()):
+        async with self._tx() as db:
+            return await db.execute(sql, params)
+
+    # products
+    async def get_active_products(self, limit: int = 50) -> list[tuple]:
+        return await self._fetchall(
+            "SELECT id, title, description, amount, currency, duration_days FROM products WHERE active=1 ORDER BY id ASC LIMIT ?",
+            (limit,),
+        )
+
+    async def get_product(self, pid: int, active_only: bool = False) -> Optional[tuple]:
+        row = await self._fetchone(
+            "SELECT id, title, description, amount, currency, duration_days, active FROM products WHERE id = ?", (pid,)
+        )
+        if row and active_only and not row[6]:
+            return None
+        return row
+
+    async def list_products(self) -> list[tuple]:
+        return await self._fetchall(
+            "SELECT id, title, amount, currency, duration_days, active FROM products ORDER BY id DESC"
+        )
+
+    async def add_product(self, title: str, description: str, amount: int, currency: str, duration_days: int) -> int:
+        cur = await self._write(
+            "INSERT INTO products (title, description, amount, currency, duration_days, active) VALUES (?, ?, ?, ?, ?, 1)",
+            (title, description, amount, currency, duration_days),
+        )
+        return cur.lastrowid
+
+    async def update_product(self, pid: int, title: str, description: str, amount: int, duration_days: int):
+        await self._write(
+            "UPDATE products SET title = ?, description = ?, amount = ?, duration_days = ? WHERE id = ?",
+            (title, description, amount, duration_days, pid),
+        )
+
+    async def set_product_active(self, pid: int, active: int):
+        await self._write("UPDATE products SET active = ? WHERE id = ?", (active, pid))
+
+    async def toggle_product(self, pid: int) -> Optional[int]:
+        async with self._tx() as db:
+            row = await self._fetchone("SELECT active FROM products WHERE id = ?", (pid,))
+            if not row:
+                return None
+            new = 0 if row[0] else 1
+            await db.execute("UPDATE products SET active = ? WHERE id = ?", (new, pid))
+        return new
+
+    async def delete_product(self, pid: int):
+        await self._write("DELETE FROM products WHERE id = ?", (pid,))
+
+    # pending donations
+    async def add_pending_donation(self, user_id: int, amount: int, message: Optional[str], created_ts: int) -> int:
+        cur = await self._write(
+            "INSERT INTO pending_donations (user_id, amount, message, created_at, created_ts) VALUES (?, ?, ?, ?, ?)",
+            (user_id, amount, message, ts_to_str(created_ts), created_ts),
+        )
+        return cur.lastrowid
+
+    async def pop_pending_donation(self, pending_id: int) -> Optional[str]:
+        async with self._tx() as db:
+            row = await self._fetchone("SELECT message FROM pending_donations WHERE id = ?", (pending_id,))
+            if not row:
+                return None
+            await db.execute("DELETE FROM pending_donations WHERE id = ?", (pending_id,))
+        return row[0]
+
+    # payments + subscriptions
+    async def record_payment(
+        self, user_id, product_id, amount, currency, charge_id, message, ts, display_name=None
+    ) -> Optional[int]:
+        expiry_ts = None
+        async with self._tx() as db:
+            await db.execute(
+                "INSERT INTO payments (user_id, product_id, amount, currency, charge_id, date, ts, message) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (user_id, product_id, amount, currency, charge_id, ts_to_str(ts), ts, message),
+            )
+            # Егер өнім болса және оның duration_days > 0 болса — жазылым кестесіне жазу
+            if product_id:
+                row = await self._fetchone(
+                    "SELECT duration_days FROM products WHERE id = ? AND active = 1", (product_id,)
+                )
+                duration_days = (row[0] or 0) if row else 0
+                if duration_days > 0:
+                    expiry_ts = ts + int(timedelta(days=duration_days).total_seconds())
+                    await db.execute(
+                        "INSERT INTO subscriptions (user_id, product_id, start_date, expiry_date, start_ts, expiry_ts, charge_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (user_id, product_id, ts_to_str(ts), ts_to_str(expiry_ts), ts, expiry_ts, charge_id),
+                    )
+            else:
+                # донат — лидерборд жиынтықтары осы транзакцияда
+                await db.execute(
+                    "INSERT INTO donor_totals (user_id, display_name, total, donations, last_ts) VALUES (?, ?, ?, 1, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET total = total + excluded.total, donations = donations + 1, "
+                    "last_ts = excluded.last_ts, display_name = COALESCE(excluded.display_name, display_name)",
+                    (user_id, display_name, amount, ts),
+                )
+                await db.execute(
+                    "INSERT INTO donor_daily (day, user_id, total) VALUES (?, ?, ?) "
+                    "ON CONFLICT(day, user_id) DO UPDATE SET total = total + excluded.total",
+                    (day_of(ts), user_id, amount),
+                )
+        return expiry_ts
+
+    async def payment_stats(self, start: Optional[int] = None, end: Optional[int] = None) -> tuple[int, int]:
+        where, params = range_clause("ts", start, end)
+        row = await self._fetchone(f"SELECT COUNT(*), SUM(amount) FROM payments{where}", params)
+        total_payments, total_amount = (row or (0, 0))
+        return total_payments or 0, total_amount or 0
+
+    async def latest_subscription(self, user_id: int) -> Optional[tuple]:
+        # (user_id, expiry_ts) индексі бойынша ең соңғы мерзім — жолдарды талдаусыз
+        return await self._fetchone(
+            "SELECT expiry_ts, product_id FROM subscriptions WHERE user_id = ? ORDER BY expiry_ts DESC LIMIT 1",
+            (user_id,),
+        )
+
+    # refunds
+    async def mark_refund(self, charge_id: str, admin_id: int, reason: str, ts: int) -> Optional[tuple[int, bool]]:
+        async with self._tx() as db:
+            payment = await self._fetchone(
+                "SELECT user_id, product_id, amount, ts, refunded, legacy FROM payments WHERE charge_id = ?", (charge_id,)
+            )
+            await db.execute("UPDATE payments SET refunded = 1 WHERE charge_id = ?", (charge_id,))
+            donation = bool(payment and payment[1] is None and not payment[4] and not payment[5])
+            if donation:
+                # қайтарылған донат лидербордтан алынады (бір рет қана)
+                user_id, _, amount, paid_ts, _, _ = payment
+                await db.execute(
+                    "UPDATE donor_totals SET total = total - ?, donations = donations - 1 WHERE user_id = ?",
+                    (amount, user_id),
+                )
+                if paid_ts is not None:
+                    await db.execute(
+                        "UPDATE donor_daily SET total = total - ? WHERE day = ? AND user_id = ?",
+                        (amount, day_of(paid_ts), user_id),
+                    )
+            await db.execute(
+                "INSERT INTO refunds (charge_id, admin_id, reason, date, ts) VALUES (?, ?, ?, ?, ?)",
+                (charge_id, admin_id, reason, ts_to_str(ts), ts),
+            )
+            await db.execute(
+                "UPDATE subscriptions SET expiry_ts = ?, expiry_date = ? WHERE charge_id = ? AND expiry_ts > ?",
+                (ts, ts_to_str(ts), charge_id, ts),
+            )
+        return (payment[0], donation) if payment else None
+
+    async def get_refunds(self, start: Optional[int] = None, end: Optional[int] = None, limit: int = 20) -> list[tuple]:
+        where, params = range_clause("ts", start, end)
+        return await self._fetchall(
+            f"SELECT charge_id, admin_id, reason, ts FROM refunds{where} ORDER BY ts DESC LIMIT ?",
+            params + (limit,),
+        )
+
+    # donor leaderboard
+    async def top_donors(self, limit: int, start_day: Optional[int] = None) -> list[tuple]:
+        if start_day is None:
+            # idx_donor_totals_total бойынша алғашқы limit жол
+            return await self._fetchall(
+                "SELECT user_id, display_name, total FROM donor_totals WHERE total > 0 ORDER BY total DESC LIMIT ?",
+                (limit,),
+            )
+        # терезе: тек сол күндердің бакеттері оқылады (PRIMARY KEY (day, user_id))
+        return await self._fetchall(
+            "SELECT d.user_id, t.display_name, SUM(d.total) AS s FROM donor_daily d "
+            "LEFT JOIN donor_totals t ON t.user_id = d.user_id "
+            "WHERE d.day >= ? GROUP BY d.user_id HAVING s > 0 ORDER BY s DESC LIMIT ?",
+            (start_day, limit),
+        )
+
+    async def donor_total(self, user_id: int) -> Optional[tuple]:
+        return await self._fetchone("SELECT display_name, total FROM donor_totals WHERE user_id = ?", (user_id,))
+
+    # broadcasts
+    async def create_broadcast(self, segment: str, text: str, ts: int) -> tuple[int, int]:
+        kind, pid = parse_segment(segment)
+        params = {"subscribers": (ts,), "payers": (), "product": (pid,)}[kind]
+        async with self._tx() as db:
+            cur = await db.execute(
+                "INSERT INTO broadcasts (segment, text, created_ts) VALUES (?, ?, ?)", (segment, text, ts)
+            )
+            broadcast_id = cur.lastrowid
+            # алушылар тізімі DB ішінде бірден жазылады — Python жадына жүктелмейді
+            cur = await db.execute(
+                "INSERT OR IGNORE INTO broadcast_recipients (broadcast_id, user_id) "
+                f"SELECT ?, user_id FROM ({SEGMENT_QUERIES[kind]})",
+                (broadcast_id,) + params,
+            )
+            total = cur.rowcount
+        return broadcast_id, total
+
+    async def get_broadcast(self, broadcast_id: Optional[int] = None) -> Optional[tuple]:
+        if broadcast_id is None:
+            return await self._fetchone("SELECT id, segment, text, status FROM broadcasts ORDER BY id DESC LIMIT 1")
+        return await self._fetchone("SELECT id, segment, text, status FROM broadcasts WHERE id = ?", (broadcast_id,))
+
+    async def broadcast_counts(self, broadcast_id: int) -> dict[int, int]:
+        rows = await self._fetchall(
+            "SELECT status, COUNT(*) FROM broadcast_recipients WHERE broadcast_id = ? GROUP BY status", (broadcast_id,)
+        )
+        return dict(rows)
+
+    async def pending_recipients(self, broadcast_id: int, after_user_id: int, limit: int) -> list[int]:
+        # keyset пагинация: PRIMARY KEY (broadcast_id, user_id) бойынша күтудегілер
+        rows = await self._fetchall(
+            "SELECT user_id FROM broadcast_recipients "
+            "WHERE broadcast_id = ? AND user_id > ? AND status = ? ORDER BY user_id LIMIT ?",
+            (broadcast_id, after_user_id, RCPT_PENDING, limit),
+        )
+        return [r[0] for r in rows]
+
+    async def set_recipient_statuses(self, broadcast_id: int, results: list[tuple[int, int]]):
+        async with self._tx() as db:
+            await db.executemany(
+                "UPDATE broadcast_recipients SET status = ? WHERE broadcast_id = ? AND user_id = ?",
+                [(status, broadcast_id, uid) for uid, status in results],
+            )
+
+    async def finish_broadcast(self, broadcast_id: int, ts: int):
+        await self._write("UPDATE broadcasts SET status = 'done', finished_ts = ? WHERE id = ?", (ts, broadcast_id))
+
+    async def running_broadcasts(self) -> list[int]:
+        rows = await self._fetchall("SELECT id FROM broadcasts WHERE status = 'running'")
+        return [r[0] for r in rows]
+
+
+# ------------------ Жадтағы backend (тесттер / бенчмарктар) ------------------
+# Диск I/O жоқ: жүктеме тесттерінде хэндлер құнын DB-дан бөліп өлшеуге болады.
+class MemoryStorage(Storage):
+    def __init__(self):
+        self.products: dict[int, dict] = {}
+        self.payments: list[dict] = []
+        self._payments_by_charge: dict[str, dict] = {}
+        self.subscriptions: list[dict] = []
+        self._subs_by_user: dict[int, list[dict]] = {}
+        self._subs_by_charge: dict[str, list[dict]] = {}
+        self.refunds: list[dict] = []
+        self.pending_donations: dict[int, dict] = {}
+        self.broadcasts: dict[int, dict] = {}
+        self.donor_totals: dict[int, dict] = {}
+        self.donor_daily: dict[tuple[int, int], int] = {}  # (day, user_id) → total
+        self._ids: dict[str, int] = {}
+
+    def _next_id(self, table: str) -> int:
+        self._ids[table] = self._ids.get(table, 0) + 1
+        return self._ids[table]
+
+    # products
+    async def get_active_products(self, limit: int = 50) -> list[tuple]:
+        rows = [
+            (p["id"], p["title"], p["description"], p["amount"], p["currency"], p["duration_days"])
+            for p in sorted(self.products.values(), key=lambda p: p["id"])
+            if p["active"]
+        ]
+        return rows[:limit]
+
+    async def get_product(self, pid: int, active_only: bool = False) -> Optional[tuple]:
+        p = self.products.get(pid)
+        if not p or (active_only and not p["active"]):
+            return None
+        return (p["id"], p["title"], p["description"], p["amount"], p["currency"], p["duration_days"], p["active"])
+
+    async def list_products(self) -> list[tuple]:
+        return [
+            (p["id"], p["title"], p["amount"], p["currency"], p["duration_days"], p["active"])
+            for p in sorted(self.products.values(), key=lambda p: p["id"], reverse=True)
+        ]
+
+    async def add_product(self, title: str, description: str, amount: int, currency: str, duration_days: int) -> int:
+        pid = self._next_id("products")
+        self.products[pid] = {
+            "id": pid,
+            "title": title,
+            "description": description,
+            "amount": amount,
+            "currency": currency,
+            "duration_days": duration_days,
+            "active": 1,
+        }
+        return pid
+
+    async def update_product(self, pid: int, title: str, description: str, amount: int, duration_days: int):
+        p = self.products.get(pid)
+        if p:
+            p.update(title=title, description=description, amount=amount, duration_days=duration_days)
+
+    async def set_product_active(self, pid: int, active: int):
+        p = self.products.get(pid)
+        if p:
+            p["active"] = active
+
+    async def toggle_product(self, pid: int) -> Optional[int]:
+        p = self.products.get(pid)
+        if not p:
+            return None
+        p["active"] = 0 if p["active"] else 1
+        return p["active"]
+
+    async def delete_product(self, pid: int):
+        self.products.pop(pid, None)
+
+    # pending donations
+    async def add_pending_donation(self, user_id: int, amount: int, message: Optional[str], created_ts: int) -> int:
+        pending_id = self._next_id("pending_donations")
+        self.pending_donations[pending_id] = {
+            "user_id": user_id,
+            "amount": amount,
+            "message": message,
+            "created_ts": created_ts,
+        }
+        return pending_id
+
+    async def pop_pending_donation(self, pending_id: int) -> Optional[str]:
+        row = self.pending_donations.pop(pending_id, None)
+        return row["message"] if row else None
+
+    # payments + subscriptions
+    async def record_payment(
+        self, user_id, product_id, amount, currency, charge_id, message, ts, display_name=None
+    ) -> Optional[int]:
+        if charge_id in self._payments_by_charge:
+            raise ValueError(f"UNIQUE constraint failed: payments.charge_id ({charge_id})")
+        payment = {
+            "user_id": user_id,
+            "product_id": product_id,
+            "amount": amount,
+            "currency": currency,
+            "charge_id": charge_id,
+            "message": message,
+            "ts": ts,
+            "refunded": 0,
+        }
+        self.payments.append(payment)
+        self._payments_by_charge[charge_id] = payment
+        if not product_id:
+            donor = self.donor_totals.setdefault(user_id, {"display_name": None, "total": 0, "donations": 0})
+            donor["total"] += amount
+            donor["donations"] += 1
+            donor["display_name"] = display_name or donor["display_name"]
+            key = (day_of(ts), user_id)
+            self.donor_daily[key] = self.donor_daily.get(key, 0) + amount
+        p = self.products.get(product_id) if product_id else None
+        if p and p["active"] and (p["duration_days"] or 0) > 0:
+            expiry_ts = ts + int(timedelta(days=p["duration_days"]).total_seconds())
+            sub = {
+                "user_id": user_id,
+                "product_id": product_id,
+                "start_ts": ts,
+                "expiry_ts": expiry_ts,
+                "charge_id": charge_id,
+            }
+            self.subscriptions.append(sub)
+            self._subs_by_user.setdefault(user_id, []).append(sub)
+            self._subs_by_charge.setdefault(charge_id, []).append(sub)
+            return expiry_ts
+        return None
+
+    async def payment_stats(self, start: Optional[int] = None, end: Optional[int] = None) -> tuple[int, int]:
+        rows = [p["amount"] for p in self.payments if _in_range(p["ts"], start, end)]
+        return len(rows), sum(rows)
+
+    async def latest_subscription(self, user_id: int) -> Optional[tuple]:
+        subs = self._subs_by_user.get(user_id)
+        if not subs:
+            return None
+        s = max(subs, key=lambda s: s["expiry_ts"] or 0)
+        return s["expiry_ts"], s["product_id"]
+
+    # refunds
+    async def mark_refund(self, charge_id: str, admin_id: int, reason: str, ts: int) -> Optional[tuple[int, bool]]:
+        self.refunds.append({"charge_id": charge_id, "admin_id": admin_id, "reason": reason, "ts": ts})
+        payment = self._payments_by_charge.get(charge_id)
+        if not payment:
+            return None
+        donation = not payment["product_id"] and not payment["refunded"]
+        if donation:
+            donor = self.donor_totals[payment["user_id"]]
+            donor["total"] -= payment["amount"]
+            donor["donations"] -= 1
+            key = (day_of(payment["ts"]), payment["user_id"])
+            self.donor_daily[key] -= payment["amount"]
+        payment["refunded"] = 1
+        for s in self._subs_by_charge.get(charge_id, ()):
+            if s["expiry_ts"] > ts:
+                s["expiry_ts"] = ts
+        return payment["user_id"], donation
+
+    async def get_refunds(self, start: Optional[int] = None, end: Optional[int] = None, limit: int = 20) -> list[tuple]:
+        rows = [r for r in self.refunds if _in_range(r["ts"], start, end)]
+        rows.sort(key=lambda r: r["ts"], reverse=True)
+        return [(r["charge_id"], r["admin_id"], r["reason"], r["ts"]) for r in rows[:limit]]
+
+    # donor leaderboard
+    async def top_donors(self, limit: int, start_day: Optional[int] = None) -> list[tuple]:
+        if start_day is None:
+            totals = {uid: d["total"] for uid, d in self.donor_totals.items()}
+        else:
+            totals: dict[int, int] = {}
+            for (day, uid), total in self.donor_daily.items():
+                if day >= start_day:
+                    totals[uid] = totals.get(uid, 0) + total
+        best = heapq.nlargest(limit, ((t, uid) for uid, t in totals.items() if t > 0))
+        return [(uid, self.donor_totals.get(uid, {}).get("display_name"), t) for t, uid in best]
+
+    async def donor_total(self, user_id: int) -> Optional[tuple]:
+        d = self.donor_totals.get(user_id)
+        return (d["display_name"], d["total"]) if d else None
+
+    # broadcasts
+    async def create_broadcast(self, segment: str, text: str, ts: int) -> tuple[int, int]:
+        kind, pid = parse_segment(segment)
+        if kind == "subscribers":
+            users = {s["user_id"] for s in self.subscriptions if (s["expiry_ts"] or 0) > ts}
+        elif kind == "payers":
+            users = {p["user_id"] for p in self.payments}
+        else:
+            users = {p["user_id"] for p in self.payments if p["product_id"] == pid}
+        broadcast_id = self._next_id("broadcasts")
+        self.broadcasts[broadcast_id] = {
+            "segment": segment,
+            "text": text,
+            "status": "running",
+            "recipients": dict.fromkeys(sorted(users), RCPT_PENDING),
+            "order": sorted(users),  # keyset пагинация үшін bisect
+        }
+        return broadcast_id, len(users)
+
+    async def get_broadcast(self, broadcast_id: Optional[int] = None) -> Optional[tuple]:
+        if broadcast_id is None:
+            broadcast_id = max(self.broadcasts, default=None)
+        b = self.broadcasts.get(broadcast_id)
+        if not b:
+            return None
+        return broadcast_id, b["segment"], b["text"], b["status"]
+
+    async def broadcast_counts(self, broadcast_id: int) -> dict[int, int]:
+        counts: dict[int, int] = {}
+        for status in self.broadcasts[broadcast_id]["recipients"].values():
+            counts[status] = counts.get(status, 0) + 1
+        return counts
+
+    async def pending_recipients(self, broadcast_id: int, after_user_id: int, limit: int) -> list[int]:
+        b = self.broadcasts[broadcast_id]
+        recipients, order = b["recipients"], b["order"]
+        pending = []
+        for i in range(bisect.bisect_right(order, after_user_id), len(order)):
+            if recipients[order[i]] == RCPT_PENDING:
+                pending.append(order[i])
+                if len(pending) == limit:
+                    break
+        return pending
+
+    async def set_recipient_statuses(self, broadcast_id: int, results: list[tuple[int, int]]):
+        recipients = self.broadcasts[broadcast_id]["recipients"]
+        for uid, status in results:
+            recipients[uid] = status
+
+    async def finish_broadcast(self, broadcast_id: int, ts: int):
+        self.broadcasts[broadcast_id]["status"] = "done"
+
+    async def running_broadcasts(self) -> list[int]:
+        return [bid for bid, b in self.broadcasts.items() if b["status"] == "running"]
+
+
+# ------------------ Backend таңдау ------------------
+def create_storage(backend: str, db_path: Optional[str] = None) -> Storage:
+    if backend == "sqlite":
+        return SqliteStorage(db_path)
+    if backend == "memory":
+        return MemoryStorage()
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
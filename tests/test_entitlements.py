@@ -0,0 +1,158 @@
+# Entitlements (LRU кэш) мен PremiumMiddleware — MemoryStorage үстінде
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram import Bot, Dispatcher, Router  # noqa: E402
+from aiogram.client.session.base import BaseSession  # noqa: E402
+from aiogram.filters import Command  # noqa: E402
+from aiogram.types import Update  # noqa: E402
+
+from entitlements import Entitlements, PremiumMiddleware  # noqa: E402
+from storage import MemoryStorage  # noqa: E402
+
+DAY = 86400
+T0 = 1_700_000_000
+
+
+class CountingStorage(MemoryStorage):
+    def __init__(self):
+        super().__init__()
+        self.lookups = 0
+
+    async def latest_subscription(self, user_id):
+        self.lookups += 1
+        return await super().latest_subscription(user_id)
+
+
+async def _storage_with_product():
+    storage = CountingStorage()
+    pid = await storage.add_product("Month", "", 50, "XTR", 30)
+    return storage, pid
+
+
+def test_miss_is_cached_including_users_without_subscription():
+    async def run():
+        storage, pid = await _storage_with_product()
+        await storage.record_payment(1, pid, 50, "XTR", "c1", None, T0)
+        ent = Entitlements(storage)
+        assert await ent.is_premium(1, now=T0 + DAY)
+        assert not await ent.is_premium(2, now=T0 + DAY)
+        assert await ent.get(2) is None
+        assert await ent.is_premium(1, now=T0 + 2 * DAY)
+        assert storage.lookups == 2
+        # мерзімі өткен жазылым кэштен оқылса да premium емес
+        assert not await ent.is_premium(1, now=T0 + 31 * DAY)
+    asyncio.run(run())
+
+
+def test_grant_only_updates_cached_entries():
+    async def run():
+        storage, pid = await _storage_with_product()
+        ent = Entitlements(storage)
+        ent.grant(1, T0 + 30 * DAY, pid)
+        assert storage.lookups == 0
+        assert await ent.get(1) is None  # grant кэшке қоспады, DB-да жазылым жоқ
+        ent.grant(1, T0 + 30 * DAY, pid)
+        assert await ent.get(1) == (T0 + 30 * DAY, pid)
+        ent.grant(1, T0 + 10 * DAY, pid)  # қысқарақ мерзім бұрынғысын ауыстырмайды
+        assert await ent.get(1) == (T0 + 30 * DAY, pid)
+        assert storage.lookups == 1
+    asyncio.run(run())
+
+
+def test_invalidate_after_refund_reloads_from_storage():
+    async def run():
+        storage, pid = await _storage_with_product()
+        await storage.record_payment(1, pid, 50, "XTR", "c1", None, T0)
+        ent = Entitlements(storage)
+        assert await ent.is_premium(1, now=T0 + DAY)
+        await storage.mark_refund("c1", 99, "test", T0 + DAY)
+        assert await ent.is_premium(1, now=T0 + 2 * DAY)  # әлі кэштен
+        ent.invalidate(1)
+        assert not await ent.is_premium(1, now=T0 + 2 * DAY)
+        assert storage.lookups == 2
+    asyncio.run(run())
+
+
+def test_lru_eviction():
+    async def run():
+        storage, _ = await _storage_with_product()
+        ent = Entitlements(storage, max_size=2)
+        await ent.get(1)
+        await ent.get(2)
+        await ent.get(1)  # 1 — ең соңғы қолданылған, 2 шығарылуы тиіс
+        await ent.get(3)
+        assert storage.lookups == 3
+        await ent.get(1)
+        assert storage.lookups == 3
+        await ent.get(2)
+        assert storage.lookups == 4
+    asyncio.run(run())
+
+
+class RecordingSession(BaseSession):
+    def __init__(self):
+        super().__init__()
+        self.requests = []
+
+    async def make_request(self, bot, method, timeout=None):
+        self.requests.append(method)
+        return None
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+def _command_update(update_id: int, user_id: int, text: str) -> Update:
+    return Update.model_validate({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": T0,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "U"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}],
+        },
+    })
+
+
+def test_premium_flag_blocks_users_without_subscription():
+    async def run():
+        storage = MemoryStorage()
+        # нақты уақытпен тексеріледі — мерзімі ұзақ өнім
+        pid = await storage.add_product("Forever", "", 50, "XTR", 36500)
+        await storage.record_payment(3, pid, 50, "XTR", "c3", None, T0)
+        ent = Entitlements(storage)
+
+        router = Router()
+        router.message.middleware(PremiumMiddleware(ent, "denied"))
+        served = []
+
+        @router.message(Command("secret"), flags={"premium": True})
+        async def secret(message):
+            served.append(message.from_user.id)
+
+        @router.message(Command("free"))
+        async def free(message):
+            served.append(("free", message.from_user.id))
+
+        dp = Dispatcher()
+        dp.include_router(router)
+        session = RecordingSession()
+        bot = Bot("42:TEST", session=session)
+
+        await dp.feed_update(bot, _command_update(1, 2, "/secret"))
+        await dp.feed_update(bot, _command_update(2, 2, "/free"))
+        await dp.feed_update(bot, _command_update(3, 3, "/secret"))
+
+        assert served == [("free", 2), 3]
+        assert [r.text for r in session.requests] == ["denied"]
+        assert session.requests[0].chat_id == 2
+    asyncio.run(run())
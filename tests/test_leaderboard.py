@@ -0,0 +1,71 @@
+# Инкременттік top-K (жалқау heap, on_donation/on_refund) storage.top_donors-пен сәйкес келуі керек
+import asyncio
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from leaderboard import Leaderboard  # noqa: E402
+from storage import MemoryStorage, SqliteStorage, now_ts  # noqa: E402
+
+K = 5
+DAY = 86400
+
+
+async def _fuzz(storage, seed: int, steps: int = 400):
+    rng = random.Random(seed)
+    await storage.init()
+    try:
+        pid = await storage.add_product("Month", "", 50, "XTR", 30)
+        board = Leaderboard(storage, K)
+        charges = []
+        for i in range(steps):
+            r = rng.random()
+            if r < 0.6:
+                uid, amount, cid = rng.randint(1, 30), rng.randint(1, 50), f"c{i}"
+                ts = now_ts() - rng.randint(0, 40 * DAY)
+                await storage.record_payment(uid, None, amount, "XTR", cid, None, ts, f"u{uid}")
+                await board.on_donation(uid, f"u{uid}", amount)
+                charges.append(cid)
+            elif r < 0.7:
+                # өнім сатып алу рейтингке әсер етпейді
+                cid = f"p{i}"
+                await storage.record_payment(rng.randint(1, 30), pid, 50, "XTR", cid, None, now_ts())
+                charges.append(cid)
+            elif r < 0.85 and charges:
+                refunded = await storage.mark_refund(rng.choice(charges), 1, "test", now_ts())
+                if refunded and refunded[1]:
+                    board.on_refund(refunded[0])
+            else:
+                got = await board.top()
+                expected = await storage.top_donors(K)
+                # тең сомалардың реті backend-ке байланысты — сомалар тізімі мен әр донордың сомасын тексереміз
+                assert [t for _, _, t in got] == [t for _, _, t in expected], (seed, i)
+                for uid, name, total in got:
+                    assert await storage.donor_total(uid) == (name, total), (seed, i, uid)
+    finally:
+        await storage.close()
+
+
+@pytest.mark.parametrize("seed", range(25))
+def test_top_matches_storage_memory(seed):
+    asyncio.run(_fuzz(MemoryStorage(), seed))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_top_matches_storage_sqlite(tmp_path, seed):
+    asyncio.run(_fuzz(SqliteStorage(str(tmp_path / "bot.db")), seed))
+
+
+def test_window_cache_cleared_on_donation():
+    async def run():
+        storage = MemoryStorage()
+        board = Leaderboard(storage, K)
+        assert await board.top_window(7) == []
+        await storage.record_payment(1, None, 10, "XTR", "c1", None, now_ts(), "u1")
+        await board.on_donation(1, "u1", 10)
+        assert await board.top_window(7) == [(1, "u1", 10)]
+    asyncio.run(run())
@@ -0,0 +1,69 @@
+# Екі backend (SqliteStorage / MemoryStorage) бір операциялар тізбегіне бірдей жауап беруі керек.
+import asyncio
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import MemoryStorage, SqliteStorage, RCPT_SENT  # noqa: E402
+
+DAY = 86400
+T0 = 1_700_000_000
+
+
+async def _scenario(storage) -> list:
+    await storage.init()
+    out = []
+    try:
+        pid = await storage.add_product("Month", "30 days", 50, "XTR", 30)
+        once = await storage.add_product("Pack", "one-off", 10, "XTR", 0)
+        rng = random.Random(42)
+        charges = []
+        for i in range(300):
+            uid = rng.randint(1, 40)
+            ts = T0 + i * DAY // 7
+            kind = rng.random()
+            product_id = pid if kind < 0.3 else once if kind < 0.4 else None
+            cid = f"c{i}"
+            charges.append(cid)
+            out.append(("pay", await storage.record_payment(uid, product_id, rng.randint(1, 100), "XTR", cid, None, ts, f"u{uid}")))
+            if rng.random() < 0.15:
+                # кейде кездейсоқ (бұрынғы немесе қайталанған) төлем қайтарылады
+                out.append(("refund", await storage.mark_refund(rng.choice(charges), 1, "test", ts + 1)))
+        out.append(("refund-missing", await storage.mark_refund("nope", 1, "test", T0)))
+
+        end = T0 + 300 * DAY // 7
+        out.append(("stats", await storage.payment_stats()))
+        out.append(("stats-range", await storage.payment_stats(T0 + 10 * DAY, T0 + 20 * DAY)))
+        out.append(("top", await storage.top_donors(10)))
+        out.append(("top-window", await storage.top_donors(10, end // DAY - 7)))
+        for uid in range(1, 41):
+            out.append(("sub", uid, await storage.latest_subscription(uid)))
+            out.append(("donor", uid, await storage.donor_total(uid)))
+        out.append(("refunds", await storage.get_refunds(limit=100)))
+
+        bid, total = await storage.create_broadcast("subscribers", "hi", end)
+        out.append(("broadcast", total))
+        batch = await storage.pending_recipients(bid, -1, 5)
+        await storage.set_recipient_statuses(bid, [(uid, RCPT_SENT) for uid in batch])
+        out.append(("pending", batch, await storage.pending_recipients(bid, -1, 100)))
+        out.append(("counts", await storage.broadcast_counts(bid)))
+    finally:
+        await storage.close()
+    return out
+
+
+def test_backends_agree(tmp_path):
+    sqlite = asyncio.run(_scenario(SqliteStorage(str(tmp_path / "bot.db"))))
+    memory = asyncio.run(_scenario(MemoryStorage()))
+    assert [tuple(map(_norm, row)) for row in sqlite] == [tuple(map(_norm, row)) for row in memory]
+
+
+def _norm(value):
+    # aiosqlite кортеждері мен тізімдерін салыстыру үшін бір пішінге келтіреміз
+    if isinstance(value, list):
+        return [_norm(v) for v in value]
+    if isinstance(value, tuple):
+        return tuple(_norm(v) for v in value)
+    return value